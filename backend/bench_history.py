@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+# Benchmarks reconstructing the history of a material type (GET /change/{material_id})
+# on a synthetic course, against the previous implementation of get_history that
+# scanned all changes for every item and timestamp. No database is needed.
+#
+#   python bench_history.py [items] [sync runs] [modified fraction per run]
+import controllers.frontend_api as fapi
+from datetime import datetime, timedelta
+import jsondiff
+import json
+import random
+import sys
+import time
+
+
+def synthetic_changes(items, runs, modified, seed=0):
+    """
+    Creates the changes rows the cron job would store for a course with the
+    given number of items, synced runs times, where a fraction of the items
+    is modified in every run.
+    """
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    rows = dict()
+    latest = dict()
+    next_id = 1
+    for run in range(runs):
+        timestamp = start + timedelta(hours=run)
+        for item_id in range(items):
+            data = {'id': item_id, 'title': f'Item {item_id}', 'body': f'<p>version {run}</p>', 'points': run}
+            previous = latest.get(item_id)
+            if previous is None:
+                change_type, older_diff = 'Addition', None
+            elif run and rng.random() < modified:
+                old = rows.pop(previous)
+                diff = jsondiff.diff(data, json.loads(old['diff']))
+                rows[next_id] = dict(old, id=next_id, diff=json.dumps(diff))
+                change_type, older_diff = 'Modification', next_id
+                next_id += 1
+            else:
+                continue
+            rows[next_id] = {
+                'id': next_id, 'item_id': item_id, 'course_id': 1, 'change_type': change_type,
+                'timestamp': timestamp, 'item_type': 'Pages', 'older_diff': older_diff,
+                'diff': json.dumps(data), 'highlights': None
+            }
+            latest[item_id] = next_id
+            next_id += 1
+    return list(rows.values())
+
+
+def legacy_history(changes):
+    """
+    The previous get_history, with the json/json subprocess replaced by
+    jsondiff so only the algorithm is compared.
+    """
+    item_ids = set([change['item_id'] for change in changes])
+    timestamps = sorted(list(set([change['timestamp'] for change in changes])), reverse=True)
+
+    histories = dict()
+    for item_id in item_ids:
+        item_changes = [change for change in changes if change['item_id'] == item_id]
+        history = []
+        first_version = dict(max(item_changes, key=lambda change: change['timestamp']))
+        for timestamp in timestamps:
+            change_record = [change for change in item_changes if change['timestamp'] == timestamp]
+            if change_record:
+                change = dict(change_record[0])
+                if change == first_version:
+                    change['content'] = json.loads(change.pop('diff'))
+                else:
+                    change['content'] = jsondiff.patch(history[-1]['content'], json.loads(change.pop('diff')))
+                history.append(change)
+            elif history and history[-1]['older_diff']:
+                copied = history[-1].copy()
+                copied['timestamp'] = timestamp
+                history.append(copied)
+        histories[item_id] = history[::-1]
+
+    timestamps = timestamps[::-1]
+    for item_id in item_ids:
+        for timestamp in timestamps:
+            version = histories[item_id]
+            matching_entry = [entry for entry in version if entry['timestamp'] == timestamp]
+            if not matching_entry and histories[item_id][-1]['timestamp'] < timestamp:
+                copied = histories[item_id][-1].copy()
+                copied['timestamp'] = timestamps[len(histories[item_id])]
+                histories[item_id].append(copied)
+
+    history = []
+    for timestamp in timestamps:
+        step = []
+        for item_id in sorted(item_ids):
+            matching_entry = [entry for entry in histories[item_id] if entry['timestamp'] == timestamp]
+            if matching_entry:
+                for key, value in matching_entry[0].items():
+                    if isinstance(value, datetime):
+                        matching_entry[0][key] = value.isoformat()
+                step.append(matching_entry[0])
+        history.append(step)
+    return history
+
+
+def measure(method, changes):
+    start = time.perf_counter()
+    result = method(changes)
+    return result, time.perf_counter() - start
+
+
+def main(items, runs, modified):
+    changes = synthetic_changes(items, runs, modified)
+    print(f"{len(changes)} changes, {items} items, {runs} sync runs")
+
+    new, new_time = measure(fapi.build_history, changes)
+    print(f"build_history: {new_time:.3f}s")
+    old, old_time = measure(legacy_history, changes)
+    print(f"legacy:        {old_time:.3f}s ({old_time / new_time:.1f}x slower)")
+
+    # every synthetic item exists from the first run, where both agree
+    print("identical output:", json.dumps(new) == json.dumps(old))
+
+
+if __name__ == '__main__':
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 500,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 40,
+        float(sys.argv[3]) if len(sys.argv) > 3 else 0.5
+    )
@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+# Benchmarks importing a new course: inserting every item one row at a time
+# through post_change, the ChangeWriter batch and the COPY bulk import.
+# Needs the database from the .env file, the benchmark rows are removed again.
+#
+#   python bench_import.py [items] [item size in bytes]
+import program as prog
+import controllers.frontend_api as fapi
+import cron_job
+from db.get_db_conn import create_pool
+from datetime import datetime
+import asyncio
+import json
+import sys
+import time
+
+
+class FakeItem:
+    def __init__(self, data):
+        self.data = data
+
+    def get_data(self):
+        return self.data
+
+
+class FakeCanvas:
+    """
+    Serves the same synthetic items for every listing of a course.
+    """
+
+    def __init__(self, count, size):
+        self.count = count
+        self.body = '<p>' + 'x' * size + '</p>'
+
+    async def _listing(self, id_key):
+        for i in range(self.count):
+            yield FakeItem({id_key: i, 'url': f'item-{i}', 'name': f'Item {i}', 'body': self.body})
+
+    def get_pages(self, course):
+        return self._listing('page_id')
+
+    def get_assignments(self, course):
+        return self._listing('id')
+
+    def get_quizes(self, course):
+        return self._listing('id')
+
+    def get_modules(self, course):
+        return self._listing('id')
+
+    def get_sections(self, course):
+        return self._listing('id')
+
+
+async def row_by_row(pool, api, course, course_id, timestamp):
+    count = 0
+    for item_type, type_items in (await cron_job.fetch_items(api, course)).items():
+        id_key = cron_job.get_id_key(item_type)
+        for item in type_items:
+            data = item.get_data()
+            await fapi.post_change(pool, course_id, prog.ChangeCreate(
+                item_id=data[id_key],
+                course_id=course_id,
+                change_type='Addition',
+                timestamp=timestamp,
+                item_type=item_type,
+                older_diff=0,
+                diff=json.dumps(data)
+            ))
+            count += 1
+    return count
+
+
+async def change_writer(pool, api, course, course_id, timestamp):
+    writer = cron_job.ChangeWriter(pool, course_id)
+    count = 0
+    for item_type, type_items in (await cron_job.fetch_items(api, course)).items():
+        count += await cron_job.save_new_items(writer, type_items, course_id, item_type, timestamp)
+    await writer.flush()
+    return count
+
+
+async def bulk_import(pool, api, course, course_id, timestamp):
+    # the course row itself is part of the bulk import
+    return await cron_job.import_new_course(api, pool, course, course_id, timestamp) - 1
+
+
+async def main(count, size):
+    pool = await create_pool()
+    api = FakeCanvas(count, size)
+    course = FakeItem({'id': 0, 'name': 'Benchmark', 'course_code': f'BENCH{time.time_ns()}'})
+    err, course_id = await fapi.post_course(pool, time.time_ns() % 2**31, 'Benchmark', course.get_data()['course_code'])
+    if err != 200:
+        raise Exception(f"Error: {err} - {course_id}")
+
+    try:
+        for name, method in (('post_change', row_by_row), ('ChangeWriter', change_writer), ('COPY', bulk_import)):
+            start = time.perf_counter()
+            imported = await method(pool, api, course, course_id, datetime.now())
+            elapsed = time.perf_counter() - start
+            print(f"{name:>12}: {imported} items in {elapsed:.2f}s ({imported / elapsed:.1f} items/s)")
+            async with pool.acquire() as conn:
+                await conn.execute('DELETE FROM changes WHERE course_id = $1', course_id)
+    finally:
+        await fapi.remove_course_by_id(pool, course_id)
+        await pool.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 1000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    ))
@@ -1,4 +1,8 @@
+import asyncio
+import collections
 import httpx
+import orjson
+import re
 
 
 def flatten_dict(indict: dict) -> dict:
@@ -47,3 +51,140 @@ def get_link_rel(response: httpx.Response, target: str):
             if rel == target:
                 return url
     return None
+
+
+def is_unchanged(response: httpx.Response) -> bool:
+    """
+    Checks if the connection served the response from its validator cache,
+    because canvas answered 304 Not Modified.
+    """
+    return response.extensions.get("unchanged", False)
+
+
+def get_page_urls(response: httpx.Response):
+    """
+    Gets the urls of all pages after the first from the rel="last" link,
+    None if canvas did not send it or it does not use page numbers.
+    """
+    last = get_link_rel(response, "last")
+    if last is None:
+        return None
+    last = httpx.URL(last)
+    page = last.params.get("page")
+    if page is None or not page.isdigit():
+        return None
+    return [last.copy_set_param("page", i) for i in range(2, int(page) + 1)]
+
+
+async def prefetch(urls, fetch, limit):
+    """
+    Fetches urls concurrently, at most limit at a time, and yields the
+    results in the order of urls.
+    """
+    urls = iter(urls)
+    pending = collections.deque()
+    try:
+        for url in urls:
+            pending.append(asyncio.ensure_future(fetch(url)))
+            if len(pending) >= limit:
+                break
+        while pending:
+            result = await pending.popleft()
+            url = next(urls, None)
+            if url is not None:
+                pending.append(asyncio.ensure_future(fetch(url)))
+            yield result
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+_TOKENS = re.compile(rb'[\[\]{}",]')
+_STRING_TOKENS = re.compile(rb'["\\]')
+
+
+class JsonArrayDecoder:
+    """
+    Decodes a JSON array incrementally. Bytes are fed as they arrive and
+    every element is parsed with orjson as soon as it is complete, so at most
+    one element is buffered.
+    """
+
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._element_start = None
+        self._done = False
+
+    def _emit(self, end: int, items: list) -> None:
+        element = bytes(self._buffer[self._element_start:end]).strip()
+        if element:
+            items.append(orjson.loads(element))
+
+    def feed(self, chunk: bytes) -> list:
+        """
+        Feeds the next bytes and returns the elements completed by them.
+        """
+        self._buffer += chunk
+        buffer = self._buffer
+        items = []
+        pos = self._pos
+        while not self._done:
+            if self._in_string:
+                match = _STRING_TOKENS.search(buffer, pos)
+                if match is None:
+                    pos = len(buffer)
+                    break
+                i = match.start()
+                if buffer[i] == ord("\\"):
+                    if i + 1 >= len(buffer):
+                        # the escaped character is in the next chunk
+                        pos = i
+                        break
+                    pos = i + 2
+                else:
+                    self._in_string = False
+                    pos = i + 1
+                continue
+
+            match = _TOKENS.search(buffer, pos)
+            if match is None:
+                pos = len(buffer)
+                break
+            i = match.start()
+            c = buffer[i]
+            pos = i + 1
+            if self._depth == 0 and c != ord("["):
+                raise ValueError("Expected a JSON array")
+
+            if c == ord('"'):
+                self._in_string = True
+            elif c in b"[{":
+                self._depth += 1
+                if self._depth == 1:
+                    self._element_start = pos
+            elif c in b"]}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._emit(i, items)
+                    self._done = True
+            elif self._depth == 1:
+                self._emit(i, items)
+                self._element_start = pos
+
+        # drop everything before the element that is being read
+        cut = pos if self._element_start is None or self._done else self._element_start
+        del buffer[:cut]
+        self._pos = pos - cut
+        if self._element_start is not None:
+            self._element_start -= cut
+        return items
+
+    def close(self) -> None:
+        """
+        Checks that the whole array was read.
+        """
+        if not self._done:
+            raise ValueError("Incomplete JSON array")
@@ -1,7 +1,8 @@
 #!/usr/bin/python3
 import canvas._impl as _impl
+import contextlib
 import httpx
-import json
+import orjson
 import typing
 
 
@@ -22,6 +23,32 @@ class CanvasConnection:
     ) -> httpx.Response:
         raise NotImplementedError()
 
+    def stream(
+        self,
+        method: str,
+        url: httpx.URL | str,
+        *,
+        params=None,
+    ) -> typing.AsyncContextManager[httpx.Response]:
+        """
+        Like request, but used as an async context manager that gives the
+        response before its body is read. By default the whole response
+        is read first.
+        """
+
+        @contextlib.asynccontextmanager
+        async def read():
+            yield await self.request(method, url, params=params)
+
+        return read()
+
+    def commit_validators(self, prefix: str) -> None:
+        """
+        Keeps the cached validators of the responses to urls equal to or
+        below prefix, once they are processed. Does nothing by default.
+        """
+        pass
+
 
 class MissingRelatedObjects(RuntimeError):
     """
@@ -68,6 +95,7 @@ class CanvasObject:
         self._id: int | None = None
         self._canvas: "Canvas" = canvas
         self._related = None
+        self._unchanged = False
 
     def get_canvas_post_arg_name(self) -> str:
         """
@@ -167,6 +195,20 @@ class CanvasObject:
         """
         return self._data is not None
 
+    def is_unchanged(self) -> bool:
+        """
+        Checks if canvas reported the object as not modified since the
+        response it was read from was last committed by the connection.
+        """
+        return self._unchanged
+
+    def set_unchanged(self, unchanged: bool) -> "CanvasObject":
+        """
+        Sets whether the object is unchanged.
+        """
+        self._unchanged = unchanged
+        return self
+
     def get_data(self, raise_on_unresolved=True) -> dict:
         """
         gets a canvas objects parsed data in the same format as
@@ -237,8 +279,8 @@ class CanvasObject:
             )
             res = await self._canvas.get_connection().request("GET", url)
             ResponseError.raise_on_error(res)
-            self.json_init(json.load(res))
-            return self
+            self.json_init(orjson.loads(res.content))
+            return self.set_unchanged(_impl.is_unchanged(res))
 
         return await self.apply_based_on_related(
             *(
@@ -248,6 +290,51 @@ class CanvasObject:
         )
 
     def get_list(self) -> typing.AsyncGenerator["CanvasObject", None]:
+        """
+        Lists objects of this type. If canvas tells how many pages there are,
+        the remaining pages are fetched concurrently after the first one.
+        With stream_lists set on the canvas object, pages are fetched one
+        at a time and objects are yielded while a page is being decoded.
+        Streamed pages are not stored for conditional requests.
+        """
+
+        async def fetch(url, params=None):
+            res = await self._canvas.get_connection().request(
+                "GET", url, params=params
+            )
+            ResponseError.raise_on_error(res)
+            return res
+
+        def make_object(r, unchanged):
+            return (
+                type(self)(self.get_canvas())
+                .json_init(r)
+                .set_related(*self._related.values())
+                .set_unchanged(unchanged)
+            )
+
+        def make_objects(res):
+            unchanged = _impl.is_unchanged(res)
+            for r in orjson.loads(res.content):
+                yield make_object(r, unchanged)
+
+        async def stream_objects(url, params, responses):
+            # decodes the page while it arrives, the response is kept
+            # in responses for its link header
+            async with self._canvas.get_connection().stream(
+                "GET", url, params=params
+            ) as res:
+                if res.status_code < 200 or res.status_code >= 300:
+                    await res.aread()
+                    ResponseError.raise_on_error(res)
+                unchanged = _impl.is_unchanged(res)
+                decoder = _impl.JsonArrayDecoder()
+                async for chunk in res.aiter_bytes():
+                    for r in decoder.feed(chunk):
+                        yield make_object(r, unchanged)
+                decoder.close()
+            responses.append(res)
+
         async def make_url(*objs):
             url = (
                 "/api/v1"
@@ -256,16 +343,39 @@ class CanvasObject:
                 )
                 + f"/{self.get_canvas_url_part()}"
             )
+            params = {"per_page": self._canvas.get_per_page()}
+            if self._canvas.get_stream_lists():
+                # pages are streamed one after another, so at most one
+                # object is buffered instead of prefetched pages
+                responses = []
+                while url is not None:
+                    async for obj in stream_objects(url, params, responses):
+                        yield obj
+                    url = _impl.get_link_rel(responses[-1], "next")
+                    url = httpx.URL(url) if url is not None else None
+                    params = None
+                return
+
+            res = await fetch(url, params=params)
+            for obj in make_objects(res):
+                yield obj
+
+            page_urls = _impl.get_page_urls(res)
+            if page_urls is not None:
+                async for res in _impl.prefetch(
+                    page_urls, fetch, self._canvas.get_prefetch()
+                ):
+                    for obj in make_objects(res):
+                        yield obj
+                return
+
+            # without a last page, follow the next links one by one
+            url = _impl.get_link_rel(res, "next")
             while url is not None:
-                res = await self._canvas.get_connection().request("GET", url)
-                ResponseError.raise_on_error(res)
-                for r in json.load(res):
-                    yield type(self)(self.get_canvas()).json_init(
-                        r
-                    ).set_related(*self._related.values())
+                res = await fetch(httpx.URL(url))
+                for obj in make_objects(res):
+                    yield obj
                 url = _impl.get_link_rel(res, "next")
-                if url is not None:
-                    url = httpx.URL(url)
 
         return self.apply_based_on_related(
             *(
@@ -292,7 +402,7 @@ class CanvasObject:
                 "POST", url, data=flattened
             )
             ResponseError.raise_on_error(res)
-            self.json_init(json.load(res))
+            self.json_init(orjson.loads(res.content))
             return self
 
         return self.apply_based_on_related(
@@ -782,8 +892,18 @@ class Directory:
 
 
 class Canvas:
-    def __init__(self, conn: CanvasConnection) -> None:
+    def __init__(
+        self,
+        conn: CanvasConnection,
+        *,
+        per_page: int = 100,
+        prefetch: int = 4,
+        stream_lists: bool = False,
+    ) -> None:
         self._conn = conn
+        self._per_page = per_page
+        self._prefetch = prefetch
+        self._stream_lists = stream_lists
 
     def get_connection(self) -> CanvasConnection:
         """
@@ -791,6 +911,25 @@ class Canvas:
         """
         return self._conn
 
+    def get_per_page(self) -> int:
+        """
+        Gets the number of objects requested per page of a list,
+        canvas allows at most 100.
+        """
+        return self._per_page
+
+    def get_prefetch(self) -> int:
+        """
+        Gets the maximum number of pages of a list fetched at the same time.
+        """
+        return self._prefetch
+
+    def get_stream_lists(self) -> bool:
+        """
+        Gets whether list responses are decoded while they are streamed in.
+        """
+        return self._stream_lists
+
     def get_assignment_overrides(
         self, course: Course, assignment: Assignment
     ) -> typing.AsyncGenerator[AssignmentOverride, None]:
@@ -902,7 +1041,7 @@ class Canvas:
             "GET", f"/api/v1/courses/{course.get_id()}/front_page"
         )
         ResponseError.raise_on_error(res)
-        return Page(self).json_init(json.load(res)).set_related(course)
+        return Page(self).json_init(orjson.loads(res.content)).set_related(course)
 
     def get_sections(
         self, course: Course
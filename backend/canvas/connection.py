@@ -1,18 +1,216 @@
 #!/usr/bin/python3
 import asyncio
+import contextlib
 import httpx
 import sys
 import json
 import canvas.canvas as canvas
 import os
+import random
+import sqlite3
 import dotenv
 
 
+class AdaptiveLimiter:
+    """
+    Limits the number of canvas requests in flight. Canvas reports what is
+    left of its rate limit bucket in the X-Rate-Limit-Remaining header, the
+    limit grows while plenty is left and is halved when it runs low or when
+    canvas throttles a request, which is then retried after a jittered backoff.
+    """
+
+    def __init__(
+        self,
+        *,
+        initial=8,
+        minimum=1,
+        maximum=20,
+        low_remaining=100.0,
+        high_remaining=300.0,
+        max_retries=5,
+        backoff=1.0,
+        max_backoff=30.0,
+    ) -> None:
+        self.minimum = minimum
+        self.maximum = maximum
+        self.low_remaining = low_remaining
+        self.high_remaining = high_remaining
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._limit = min(max(initial, minimum), maximum)
+        self._in_flight = 0
+        self._condition = asyncio.Condition()
+        self._stats = {
+            "requests": 0,
+            "throttled": 0,
+            "retries": 0,
+            "cost": 0.0,
+            "remaining": None,
+        }
+
+    def get_stats(self) -> dict:
+        """
+        Gets the counters of the limiter.
+        """
+        return dict(
+            self._stats, limit=self._limit, in_flight=self._in_flight
+        )
+
+    async def acquire(self) -> None:
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: self._in_flight < self._limit
+            )
+            self._in_flight += 1
+
+    async def release(self, response: httpx.Response | None) -> None:
+        async with self._condition:
+            self._in_flight -= 1
+            if response is not None:
+                self._update(response)
+            self._condition.notify_all()
+
+    def record_retry(self) -> None:
+        self._stats["retries"] += 1
+
+    def is_throttled(self, response: httpx.Response) -> bool:
+        # canvas answers 403 Forbidden (Rate Limit Exceeded)
+        return response.status_code == 429 or (
+            response.status_code == 403
+            and "Rate Limit Exceeded" in response.text
+        )
+
+    def get_backoff(self, attempt: int) -> float:
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2**attempt)
+        )
+
+    def _update(self, response: httpx.Response) -> None:
+        self._stats["requests"] += 1
+        cost = response.headers.get("X-Request-Cost")
+        if cost is not None:
+            self._stats["cost"] += float(cost)
+
+        remaining = response.headers.get("X-Rate-Limit-Remaining")
+        if remaining is not None:
+            self._stats["remaining"] = float(remaining)
+
+        if self.is_throttled(response):
+            self._stats["throttled"] += 1
+            self._limit = max(self.minimum, self._limit // 2)
+        elif remaining is None:
+            return
+        elif float(remaining) < self.low_remaining:
+            self._limit = max(self.minimum, self._limit // 2)
+        elif float(remaining) > self.high_remaining:
+            self._limit = min(self.maximum, self._limit + 1)
+
+
+class ValidatorCache:
+    """
+    Stores the ETag and Last-Modified validators of canvas GET responses in a
+    local SQLite database, with the body so it can be used again when canvas
+    answers a conditional request with 304 Not Modified. New validators are
+    staged until they are committed, so responses of a sync that failed are
+    downloaded again by the next one.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS validators ("
+            "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, "
+            "link TEXT, body BLOB)"
+        )
+        self._db.commit()
+        self._staged = dict()
+
+    def get(self, url: str) -> tuple | None:
+        """
+        Gets the (etag, last_modified, link, body) stored for a url.
+        """
+        if url in self._staged:
+            return self._staged[url]
+        return self._db.execute(
+            "SELECT etag, last_modified, link, body FROM validators "
+            "WHERE url = ?",
+            (url,),
+        ).fetchone()
+
+    def store(self, url: str, response: httpx.Response) -> None:
+        """
+        Stages the validators of a read response, if it has any.
+        """
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag is None and last_modified is None:
+            return
+        self._staged[url] = (
+            etag,
+            last_modified,
+            response.headers.get("Link"),
+            response.content,
+        )
+
+    def commit(self, prefix: str) -> None:
+        """
+        Stores the staged validators of the urls equal to prefix or below it.
+        """
+        urls = [
+            url
+            for url in self._staged
+            if url == prefix
+            or url.startswith(prefix + "/")
+            or url.startswith(prefix + "?")
+        ]
+        self._db.executemany(
+            "INSERT OR REPLACE INTO validators "
+            "(url, etag, last_modified, link, body) VALUES (?, ?, ?, ?, ?)",
+            ((url, *self._staged.pop(url)) for url in urls),
+        )
+        self._db.commit()
+
+    def close(self) -> None:
+        self._staged.clear()
+        self._db.close()
+
+
 class ManualCanvasConnection(canvas.CanvasConnection):
-    def __init__(self, domain, token) -> None:
+    """
+    A canvas connection over a single pooled httpx client. It is meant to be
+    created once and shared for the lifetime of the process, so connections
+    are kept alive and (with http2) multiplexed between requests.
+    """
+
+    def __init__(
+        self,
+        domain,
+        token,
+        *,
+        max_connections=20,
+        max_keepalive_connections=10,
+        keepalive_expiry=30.0,
+        http2=True,
+        timeout=30.0,
+        limiter=None,
+        validators=None,
+    ) -> None:
         self.token = token
-        self.client = httpx.AsyncClient()
         self.domain = domain
+        self.limiter = limiter or AdaptiveLimiter(maximum=max_connections)
+        self.validators = validators
+        self._not_modified = 0
+        self.client = httpx.AsyncClient(
+            headers={"Authorization": f"Bearer {token}"},
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            http2=http2,
+            timeout=timeout,
+        )
 
     async def __aenter__(self) -> "ManualCanvasConnection":
         return self
@@ -25,21 +223,171 @@ class ManualCanvasConnection(canvas.CanvasConnection):
         data=None,
         params=None,
     ):
-        return await self.client.request(
-            method,
-            self.domain + url if isinstance(url, str) else url,
-            headers={"Authorization": f"Bearer {self.token}"},
-            data=data,
-            params=params,
+        response = await self._send(method, url, data, params, True)
+        if response is None:
+            # the stored body can not be used, request it again in full
+            response = await self._send(method, url, data, params, False)
+        return response
+
+    async def _send(self, method, url, data, params, conditional):
+        for attempt in range(self.limiter.max_retries + 1):
+            request, cached = self._build_request(
+                method, url, data, params, conditional
+            )
+            await self.limiter.acquire()
+            response = None
+            try:
+                response = await self.client.send(request)
+            finally:
+                await self.limiter.release(response)
+
+            if (
+                not self.limiter.is_throttled(response)
+                or attempt == self.limiter.max_retries
+            ):
+                return self._use_validators(request, response, cached)
+            self.limiter.record_retry()
+            await asyncio.sleep(self.limiter.get_backoff(attempt))
+
+    @contextlib.asynccontextmanager
+    async def stream(
+        self,
+        method: str,
+        url: httpx.URL | str,
+        *,
+        params=None,
+    ):
+        async with self._stream(method, url, params, True) as response:
+            if response is not None:
+                yield response
+                return
+        # the stored body can not be used, request it again in full
+        async with self._stream(method, url, params, False) as response:
+            yield response
+
+    @contextlib.asynccontextmanager
+    async def _stream(self, method, url, params, conditional):
+        for attempt in range(self.limiter.max_retries + 1):
+            request, cached = self._build_request(
+                method, url, None, params, conditional
+            )
+            await self.limiter.acquire()
+            response = None
+            try:
+                response = await self.client.send(request, stream=True)
+                try:
+                    if response.status_code in (403, 429):
+                        # the body tells if canvas throttled the request
+                        await response.aread()
+                    if (
+                        not self.limiter.is_throttled(response)
+                        or attempt == self.limiter.max_retries
+                    ):
+                        # storing the body would mean reading all of it
+                        # first, so streamed responses are not stored
+                        yield self._use_validators(
+                            request, response, cached, store=False
+                        )
+                        return
+                finally:
+                    await response.aclose()
+            finally:
+                await self.limiter.release(response)
+
+            self.limiter.record_retry()
+            await asyncio.sleep(self.limiter.get_backoff(attempt))
+
+    def _build_request(self, method, url, data, params, conditional):
+        # GET requests to urls with stored validators are made conditional
+        request = self.client.build_request(
+            method, self._make_url(url), data=data, params=params
         )
+        cached = None
+        if (
+            conditional
+            and self.validators is not None
+            and request.method == "GET"
+        ):
+            cached = self.validators.get(self._cache_key(request))
+        if cached is not None:
+            etag, last_modified, _, _ = cached
+            if etag is not None:
+                request.headers["If-None-Match"] = etag
+            if last_modified is not None:
+                request.headers["If-Modified-Since"] = last_modified
+        return request, cached
 
-    async def __aexit__(self, *_):
+    def _use_validators(self, request, response, cached, store=True):
+        # gives None if the stored body can not be used for a 304 response
+        if cached is not None and response.status_code == 304:
+            _, _, link, body = cached
+            if link is not None:
+                # a page of a list can stay the same while pages are added
+                # or removed, so only the links of canvas itself are used
+                link = response.headers.get("Link")
+                if link is None:
+                    return None
+            self._not_modified += 1
+            return httpx.Response(
+                200,
+                headers={"Link": link} if link is not None else None,
+                content=body,
+                request=request,
+                extensions={"unchanged": True},
+            )
+        if store and self.validators is not None and request.method == "GET":
+            if response.status_code == 200:
+                self.validators.store(self._cache_key(request), response)
+        return response
+
+    def _cache_key(self, request: httpx.Request) -> str:
+        return request.url.raw_path.decode()
+
+    def commit_validators(self, prefix: str) -> None:
+        if self.validators is not None:
+            self.validators.commit(prefix)
+
+    def _make_url(self, url: httpx.URL | str) -> httpx.URL | str:
+        return self.domain + url if isinstance(url, str) else url
+
+    def get_stats(self) -> dict:
+        """
+        Gets the request counters of the rate limiter and the number of
+        requests canvas answered with 304 Not Modified.
+        """
+        return dict(self.limiter.get_stats(), not_modified=self._not_modified)
+
+    async def aclose(self) -> None:
         await self.client.aclose()
+        if self.validators is not None:
+            self.validators.close()
+
+    async def __aexit__(self, *_):
+        await self.aclose()
 
-    def make_from_environment():
+    def make_from_environment(validators: bool = False):
+        """
+        Creates a connection from the environment. The cache of ETag and
+        Last-Modified validators is only used if validators is set, by
+        processes that commit it, and CANVAS_VALIDATOR_CACHE gives a path.
+        """
         dotenv.load_dotenv()
+        validators = validators and os.getenv("CANVAS_VALIDATOR_CACHE")
         return ManualCanvasConnection(
-            os.getenv("CANVAS_DOMAIN"), os.getenv("CANVAS_API_TOKEN")
+            os.getenv("CANVAS_DOMAIN"),
+            os.getenv("CANVAS_API_TOKEN"),
+            max_connections=int(os.getenv("CANVAS_MAX_CONNECTIONS", 20)),
+            max_keepalive_connections=int(
+                os.getenv("CANVAS_MAX_KEEPALIVE_CONNECTIONS", 10)
+            ),
+            keepalive_expiry=float(os.getenv("CANVAS_KEEPALIVE_EXPIRY", 30)),
+            http2=os.getenv("CANVAS_HTTP2", "1") != "0",
+            timeout=float(os.getenv("CANVAS_TIMEOUT", 30)),
+            limiter=AdaptiveLimiter(
+                initial=int(os.getenv("CANVAS_INITIAL_IN_FLIGHT", 8)),
+                maximum=int(os.getenv("CANVAS_MAX_CONNECTIONS", 20)),
+            ),
+            validators=ValidatorCache(validators) if validators else None,
         )
 
 
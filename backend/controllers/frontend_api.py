@@ -1,12 +1,14 @@
+import base64
 import json
-import traceback
-import asyncio
+import contextlib
+import time
+import orjson
 
 from os import getenv
 from datetime import datetime
+from collections import OrderedDict
 import sys
-import json
-import tempfile
+import jsondiff
 
 # import os
 # sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -15,6 +17,72 @@ import tempfile
 
 production = getenv('PRODUCTION', False)
 
+# advisory lock of the snapshots: writers that add references to snapshots share it, prune_snapshots takes it alone
+SNAPSHOTS_LOCK = 0x736e6170
+
+# serialized histories by (internal course id, item type), least recently used first
+history_cache = OrderedDict()
+HISTORY_CACHE_SIZE = int(getenv('HISTORY_CACHE_SIZE', 64))
+
+# rows read ahead by the cursor of stream_item_histories
+HISTORY_PREFETCH = int(getenv('HISTORY_PREFETCH', 500))
+
+# internal course ids by canvas course id, with the time they expire, least recently used first
+course_id_cache = OrderedDict()
+COURSE_ID_CACHE_SIZE = int(getenv('COURSE_ID_CACHE_SIZE', 1024))
+COURSE_ID_CACHE_TTL = float(getenv('COURSE_ID_CACHE_TTL', 300))
+
+
+class RequestConnection:
+    """
+    Holds a single connection of a pool for the duration of one request. It has the acquire method of the pool,
+    so it can be passed to every function of this module in place of the pool, and nested calls share the
+    connection instead of each taking one. The connection is taken on first use and returned by close.
+    """
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = None
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        if self._conn is None:
+            self._conn = await self._pool.acquire()
+        yield self._conn
+
+    async def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            await self._pool.release(conn)
+
+
+# the columns of a change as the API returns them, without the storage columns of change_records
+CHANGE_COLUMNS = 'id, item_id, course_id, change_type, timestamp, item_type, older_diff, diff, highlights'
+
+
+def change_response(change):
+    """
+    Give a change record in the shape the API returns, with the diff as JSON text.
+    """
+    if change is None:
+        return None
+    return dict(change, diff=dump_diff(change['diff']))
+
+
+def load_diff(diff):
+    """
+    Parse the diff column of a change record. TEXT columns give JSON text, JSONB columns are decoded by the codec
+    of the connection pool already.
+    """
+    return json.loads(diff) if isinstance(diff, str) else diff
+
+
+def dump_diff(diff):
+    """
+    Give the diff column of a change record as JSON text, whether it is stored as TEXT or JSONB.
+    """
+    return diff if isinstance(diff, str) else json.dumps(diff)
+
 
 def check_required_keys(json_obj, required_keys):
     for key, value in required_keys.items():
@@ -86,7 +154,7 @@ async def check_annotation_create(pool, course_id, change_id, request):
             if not user:
                 return 400, "Error: User does not have permission to annotate this change"
 
-            change = await conn.fetchrow('SELECT * FROM changes WHERE id = $1', int(change_id))
+            change = await conn.fetchrow('SELECT * FROM change_records WHERE id = $1', int(change_id))
 
             if not change:
                 return 400, "Error: Change does not exist"
@@ -168,7 +236,7 @@ async def get_change_by_materialid(pool, course_id, material_id):
     """
     print(material_id, course_id)
     async with pool.acquire() as conn:
-        changes = await conn.fetchrow('SELECT * FROM changes WHERE item_type = $1 AND course_id = $2', material_id, int(course_id))
+        changes = await conn.fetchrow('SELECT * FROM change_records WHERE item_type = $1 AND course_id = $2', material_id, int(course_id))
         changes_list = []
         for change in changes:
             change_dict = {
@@ -177,7 +245,7 @@ async def get_change_by_materialid(pool, course_id, material_id):
                 "change_type": change['change_type'],
                 "item_type": change['item_type'],
                 "timestamp": change['timestamp'],
-                "data_object": change['diff'],
+                "data_object": dump_diff(change['diff']),
                 "highlights": change['highlights']
             }
             changes_list.append(change_dict)
@@ -199,7 +267,7 @@ async def get_changes_recent(pool, course_id):
     async with pool.acquire() as conn:
         internal_course_id = await convert_course_id_to_id(pool, int(course_id))
 
-        changes = await conn.fetch('SELECT * FROM changes WHERE course_id = $1 ORDER BY timestamp DESC LIMIT 10', int(internal_course_id))
+        changes = await conn.fetch('SELECT * FROM change_records WHERE course_id = $1 ORDER BY timestamp DESC LIMIT 10', int(internal_course_id))
         change_list = []
         for change in changes:
             change_dict = {
@@ -208,12 +276,97 @@ async def get_changes_recent(pool, course_id):
                 "change_type": change['change_type'],
                 "item_type": change['item_type'],
                 "timestamp": change['timestamp'],
-                "data_objects": change['diff'],
+                "data_objects": dump_diff(change['diff']),
             }
             change_list.append(change_dict)
         return change_list
 
 
+def encode_feed_cursor(timestamp, change_id):
+    """
+    Create the cursor of the change feed that continues after the change with the given timestamp and id.
+    """
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{change_id}".encode()).decode()
+
+
+def decode_feed_cursor(cursor):
+    """
+    Parse a cursor created by encode_feed_cursor.
+
+    Returns:
+        The (timestamp, id) of the last change of the previous page.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    try:
+        timestamp, change_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(change_id)
+    except (ValueError, UnicodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+async def get_change_feed(pool, course_id, limit, cursor=None, item_type=None, item_id=None, change_type=None,
+                          include_diff=False):
+    """
+    Retrieve a page of the changes of a course, newest first. Pages are found by keyset pagination on
+    (timestamp, id), so a page costs the same however far into the archive it is.
+
+    Args:
+        pool: The connection pool to the database.
+        course_id: The Canvas ID of the course.
+        limit: The maximum number of changes on the page.
+        cursor: The next_cursor of the previous page, None for the first page.
+        item_type: Optionally only the changes of this item type.
+        item_id: Optionally only the changes of this item.
+        change_type: Optionally only the changes of this change type.
+        include_diff: Whether to include the diff of every change.
+
+    Returns:
+        A dict with the changes of the page and the next_cursor, which is None on the last page.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    internal_course_id = await convert_course_id_to_id(pool, int(course_id))
+
+    # only the filters that are used are part of the query, so the index can be used for every combination
+    conditions = ['course_id = $1']
+    args = [internal_course_id]
+    if cursor is not None:
+        args.extend(decode_feed_cursor(cursor))
+        conditions.append(f'(timestamp, id) < (${len(args) - 1}, ${len(args)})')
+    for column, value in (('item_type', item_type), ('item_id', item_id), ('change_type', change_type)):
+        if value is not None:
+            args.append(value)
+            conditions.append(f'{column} = ${len(args)}')
+    args.append(limit + 1)
+
+    columns = 'id, item_id, change_type, timestamp, item_type, older_diff, highlights'
+    # the snapshots are only needed for the diffs
+    source = 'change_records' if include_diff else 'changes'
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(f'''
+        SELECT {columns}{', diff' if include_diff else ''}
+        FROM {source}
+        WHERE {' AND '.join(conditions)}
+        ORDER BY timestamp DESC, id DESC
+        LIMIT ${len(args)}
+        ''', *args)
+
+    changes = []
+    for row in rows[:limit]:
+        change = dict(row)
+        if include_diff:
+            change['diff'] = load_diff(change['diff'])
+        changes.append(change)
+
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_feed_cursor(changes[-1]['timestamp'], changes[-1]['id'])
+    return {'changes': changes, 'next_cursor': next_cursor}
+
+
 async def get_change_by_id(pool, course_id, item_type):
     """
     Retrieve a change record by its ID.
@@ -227,8 +380,8 @@ async def get_change_by_id(pool, course_id, item_type):
         The change record if found, otherwise None.
     """
     async with pool.acquire() as conn:
-        change = await conn.fetchrow('SELECT * FROM changes WHERE course_id = $1 AND item_type = $2', int(course_id), item_type)
-        return change
+        change = await conn.fetchrow(f'SELECT {CHANGE_COLUMNS} FROM change_records WHERE course_id = $1 AND item_type = $2', int(course_id), item_type)
+        return change_response(change)
 
 
 async def get_annotation_by_id(pool, course_id, annotation_id):
@@ -244,7 +397,7 @@ async def get_annotation_by_id(pool, course_id, annotation_id):
         The annotation record if found, otherwise None.
     """
     async with pool.acquire() as conn:
-        change = await conn.fetchrow('SELECT * FROM changes WHERE course_id = $1', course_id)
+        change = await conn.fetchrow('SELECT * FROM change_records WHERE course_id = $1', course_id)
 
         annotation = await conn.fetchrow('SELECT * FROM annotations WHERE change_id = $1 AND id = $2', change[0], int(annotation_id))
 
@@ -264,7 +417,7 @@ async def delete_annotation_by_id(pool, course_id, annotation_id):
         A boolean indicating the success of the operation.
     """
     async with pool.acquire() as conn:
-        change = await conn.fetchrow('SELECT * FROM changes WHERE course_id = $1', course_id)
+        change = await conn.fetchrow('SELECT * FROM change_records WHERE course_id = $1', course_id)
 
         await conn.execute('DELETE FROM annotations WHERE change_id = $1 AND id = $2', change[0], annotation_id)
 
@@ -324,9 +477,23 @@ async def get_users(pool):
         return users
 
 
+def invalidate_course_id_cache(course_id=None, internal_course_id=None):
+    """
+    Drop cached course ID translations, called when courses are added or removed.
+
+    Args:
+        course_id: The Canvas ID of the course to drop.
+        internal_course_id: The internal ID of the course to drop.
+    """
+    course_id_cache.pop(course_id, None)
+    for key in [key for key, (value, _) in course_id_cache.items() if value == internal_course_id]:
+        del course_id_cache[key]
+
+
 async def convert_course_id_to_id(pool, course_id):
     """
-    Convert a course ID to the course code.
+    Convert a Canvas course ID to the internal ID of the course.
+    Translations are cached for COURSE_ID_CACHE_TTL seconds.
 
     Args:
         pool: The connection pool to the database.
@@ -335,10 +502,20 @@ async def convert_course_id_to_id(pool, course_id):
     Returns:
         The internal identifier of the course.
     """
+    course_id = int(course_id)
+    cached = course_id_cache.get(course_id)
+    if cached is not None and cached[1] > time.monotonic():
+        course_id_cache.move_to_end(course_id)
+        return cached[0]
+
     async with pool.acquire() as conn:
-        course = await conn.fetchrow('SELECT * FROM courses WHERE $1 = ANY(course_ids)', int(course_id))
-        print("TEST", course, "TEST")
-        return course['id']
+        course = await conn.fetchrow('SELECT id FROM courses WHERE course_ids @> ARRAY[$1::integer]', course_id)
+
+    course_id_cache[course_id] = (course['id'], time.monotonic() + COURSE_ID_CACHE_TTL)
+    course_id_cache.move_to_end(course_id)
+    while len(course_id_cache) > COURSE_ID_CACHE_SIZE:
+        course_id_cache.popitem(last=False)
+    return course['id']
 
 
 async def get_user_by_id(pool, user_id, course_id):
@@ -429,7 +606,28 @@ async def get_changes_by_courseid(pool, course_id):
         A list of changes matching the given course ID.
     """
     async with pool.acquire() as conn:
-        changes = await conn.fetch('SELECT * FROM changes WHERE course_id = $1', course_id)
+        changes = await conn.fetch(f'SELECT {CHANGE_COLUMNS} FROM change_records WHERE course_id = $1', course_id)
+        return [change_response(change) for change in changes]
+
+
+async def get_latest_changes_by_courseid(pool, course_id):
+    """
+    Retrieve only the most recent change of every item in a course.
+
+    Args:
+        pool: The connection pool to the database.
+        course_id: The ID of the course to retrieve changes for.
+
+    Returns:
+        A list with the newest change per (item_type, item_id).
+    """
+    async with pool.acquire() as conn:
+        changes = await conn.fetch('''
+        SELECT DISTINCT ON (item_type, item_id) *
+        FROM change_records
+        WHERE course_id = $1
+        ORDER BY item_type, item_id, id DESC
+        ''', course_id)
         return changes
 
 
@@ -461,8 +659,8 @@ async def get_change_by_id(pool, change_id):
         The change record as a dictionary, or None if the change is not found.
     """
     async with pool.acquire() as conn:
-        change = await conn.fetchrow('SELECT * FROM changes WHERE id = $1', change_id)
-        return change
+        change = await conn.fetchrow(f'SELECT {CHANGE_COLUMNS} FROM change_records WHERE id = $1', change_id)
+        return change_response(change)
 
 
 async def get_changes_by_course_id_and_item_type(pool, course_id, item_type):
@@ -478,8 +676,8 @@ async def get_changes_by_course_id_and_item_type(pool, course_id, item_type):
     """
     async with pool.acquire() as conn:
         internal_course_id = await convert_course_id_to_id(pool, int(course_id))
-        changes = await conn.fetch('SELECT * FROM changes WHERE item_type = $1 AND course_id = $2', item_type, internal_course_id)
-        return changes
+        changes = await conn.fetch(f'SELECT {CHANGE_COLUMNS} FROM change_records WHERE item_type = $1 AND course_id = $2', item_type, internal_course_id)
+        return [change_response(change) for change in changes]
 
 
 async def get_changes_by_item(pool, item_id, item_type):
@@ -496,48 +694,8 @@ async def get_changes_by_item(pool, item_id, item_type):
         A list of changes matching the given item ID and item type.
     """
     async with pool.acquire() as conn:
-        changes = await conn.fetch('SELECT * FROM changes WHERE item_id = $1 AND item_type = $2', item_id, item_type)
-        return changes
-
-
-# probably temporary solution with tempfile, will switch to server process
-# instead of subprocess
-
-
-async def get_patched(json_data, patch):
-    print('currently in get_patched')
-    json_diff_path = './json/json'
-    str1 = json.dumps(json_data)
-    str2 = json.dumps(patch)
-    print('str1', str1) # works
-    print('str2', str2) # works
-    with tempfile.TemporaryFile() as f:
-        f.write(b'patch')
-        f.write(b'\n')
-        f.write(str1.encode())
-        f.write(b'\n')
-        f.write(str2.encode())
-        f.seek(0)
-
-        file_content = f.read()
-
-    print('after with logic') # works
-
-    process = await asyncio.create_subprocess_exec(
-        json_diff_path,
-        stdin=asyncio.subprocess.PIPE,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
-    )
-
-    print('process', process) # works
-
-    output = (await process.communicate(input=file_content))[0].decode()
-    print('output in get_patched', output) # `output` is null/undefined
-    if output:
-        return json.loads(output.rstrip('\n'))
-    else:
-        return None # Vraag aan Bas hoe en wat
+        changes = await conn.fetch(f'SELECT {CHANGE_COLUMNS} FROM change_records WHERE item_id = $1 AND item_type = $2', item_id, item_type)
+        return [change_response(change) for change in changes]
 
 
 async def get_most_recent(changes):
@@ -557,94 +715,326 @@ async def get_most_recent(changes):
     return most_recent
 
 
-async def get_history(pool, course_id, item_type):
+def build_item_history(records, timestamps):
     """
-    Retrieve the history of an item from the database.
+    Reconstruct all versions of a single item by walking its version chain once.
+    The walk starts over at every keyframe, so a broken diff only affects the versions up to the next one.
 
     Args:
-        pool: The connection pool to the database.
-        item_id: The ID of the item.
-        item_type: The type of the item.
+        records: The changes of the item by timestamp.
+        timestamps: All timestamps of the history in ascending order.
 
     Returns:
-        A list of changes associated with the item.
-    """
-    changes = await get_changes_by_course_id_and_item_type(pool, course_id, item_type)
-
-    item_ids = set([change['item_id'] for change in changes])
-    timestamps = set([change['timestamp'] for change in changes])
-    timestamps = sorted(list(timestamps), reverse=True)
-
-    # collect all relevant information for each item
-    histories = dict()
-    for item_id in item_ids:
-        item_changes = [
-            change for change in changes if change['item_id'] == item_id]
-
-        history = []
-        first_version = await get_most_recent(item_changes)
-        first_version = dict(first_version)
-        for timestamp in timestamps:
-            change_record = [
-                change for change in item_changes if change['timestamp'] == timestamp]
-            if change_record:
-                change = dict(change_record[0])
-                if change == first_version:
-                    change['content'] = json.loads(change['diff'])
-                    change.pop('diff')
-                    history.append(change)
-                else:
-                    change['diff'] = json.loads(change['diff'])
-                    change['content'] = await get_patched(history[-1]['content'], change['diff'])
-                    change.pop('diff')
-                    history.append(change)
-            elif history:
-                copied = history[-1].copy()
-
-                # only add intermediate version if there is an older version
-                if copied['older_diff']:
-                    copied['timestamp'] = timestamp
-                    history.append(copied)
-
-        histories[item_id] = history[::-1]
-
-    timestamps = timestamps[::-1]
-
-    # make sure there is a version for each timestamp since creation
-    for item_id in item_ids:
-        for timestamp in timestamps:
-            version = histories[item_id]
-            matching_entry = [
-                entry for entry in version if entry['timestamp'] == timestamp]
-            if not matching_entry and histories[item_id][-1]['timestamp'] < timestamp:
-                copied = histories[item_id][-1].copy()
-                timestamp_index = len(histories[item_id])
-                copied['timestamp'] = timestamps[timestamp_index]
-                histories[item_id].append(copied)
+        A dictionary of timestamp to the version of the item at that time.
+    """
+    newest = max(records)
+    history = dict()
+    last = None
+    content = None
+
+    # walk back from the newest version, patching with each reverse diff
+    for timestamp in reversed(timestamps):
+        if timestamp > newest:
+            # make sure there is a version for each timestamp since creation
+            continue
+        change = records.get(timestamp)
+        if change is not None:
+            entry = dict(change)
+            diff = load_diff(entry.pop('diff'))
+            # the newest version and keyframes (older versions with a content hash) are stored in full
+            if timestamp == newest or entry.get('content_hash') is not None:
+                content = diff
+            else:
+                content = jsondiff.try_patch(content, diff)
+            entry['content'] = content
+            history[timestamp] = last = entry
+
+        # only add intermediate version if there is an older version
+        elif last['older_diff']:
+            copied = last.copy()
+            copied['timestamp'] = timestamp
+            history[timestamp] = copied
+
+    newest_entry = history[newest]
+    for timestamp in timestamps:
+        if timestamp > newest:
+            copied = newest_entry.copy()
+            copied['timestamp'] = timestamp
+            history[timestamp] = copied
+
+    return history
+
+
+def iter_history(changes):
+    """
+    Reconstruct the history of all items from their changes, like build_history, but convert the steps
+    one at a time while they are read.
+
+    Args:
+        changes: The changes of one item type in a course.
+
+    Yields:
+        A step for every timestamp in ascending order, holding the version of every item that existed at that time.
+    """
+    # group the changes per item and timestamp once
+    records = dict()
+    for change in changes:
+        records.setdefault(change['item_id'], dict()).setdefault(change['timestamp'], change)
+    timestamps = sorted({change['timestamp'] for change in changes})
+
+    histories = [build_item_history(records[item_id], timestamps) for item_id in sorted(records)]
 
     # convert to desired format
-    history = []
     for timestamp in timestamps:
         step = []
-        for item_id in item_ids:
-            version = histories[item_id]
-            matching_entry = [
-                entry for entry in version if entry['timestamp'] == timestamp]
-
-            if matching_entry:  # Check if matching_entry is not empty
-                # convert datetime to string
-                for key, value in matching_entry[0].items():
-                    if isinstance(value, datetime):
-                        matching_entry[0][key] = value.isoformat()
-
-                step.append(matching_entry[0])
-            else:
-                # Handle the case where there is no matching entry
-                # You might want to append a default value or continue to the next iteration
-                continue  # or handle appropriately
-        history.append(step)
+        for item_history in histories:
+            entry = item_history.get(timestamp)
+            if entry is None:
+                continue
+            # convert datetime to string
+            for key, value in entry.items():
+                if isinstance(value, datetime):
+                    entry[key] = value.isoformat()
+            step.append(entry)
+        yield step
+
+
+def build_history(changes):
+    """
+    Reconstruct the history of all items from their changes.
+    Every change is visited a constant number of times.
+
+    Args:
+        changes: The changes of one item type in a course.
+
+    Returns:
+        A list with a step for every timestamp in ascending order, each step
+        holding the version of every item that existed at that time.
+    """
+    return list(iter_history(changes))
+
+
+def format_history(steps):
+    """
+    Merge every step of a history into the document shown by the change view: the first version of the step
+    with the contents of all items, linked to the document of the previous step by older_diff.
+
+    Args:
+        steps: The steps of iter_history or build_history, they are not modified.
+
+    Yields:
+        A document for every step that has versions.
+    """
+    index = 0
+    for step in steps:
+        if not step:
+            continue
+        document = dict(step[0], id=index, content=[entry['content'] for entry in step])
+        if index:
+            document['older_diff'] = index - 1
+        yield document
+        index += 1
+
+
+def invalidate_history_cache(course_id):
+    """
+    Drop the cached histories of a course, called when new changes are written for it.
+
+    Args:
+        course_id: The internal ID of the course.
+    """
+    for key in [key for key in history_cache if key[0] == course_id]:
+        del history_cache[key]
+
+
+async def _json_array(chunks):
+    yield b'['
+    for index, chunk in enumerate(chunks):
+        yield b',' + chunk if index else chunk
+    yield b']'
+
+
+def _serialize_history(key, version, changes):
+    # the documents are serialized while they are reconstructed, the history is cached once it is complete
+    documents = []
+    for document in format_history(iter_history(changes)):
+        documents.append(orjson.dumps(document))
+        yield documents[-1]
+
+    history_cache[key] = (version, documents)
+    history_cache.move_to_end(key)
+    while len(history_cache) > HISTORY_CACHE_SIZE:
+        history_cache.popitem(last=False)
+
+
+async def get_history_chunks(pool, course_id, item_type):
+    """
+    Retrieve the history of an item type of a course, as the documents of format_history.
+    The changes are read before this returns, the history is reconstructed while the chunks are consumed.
+    The serialized history is cached until the changes of the item type change.
+
+    Args:
+        pool: The connection pool to the database.
+        course_id: The Canvas ID of the course.
+        item_type: The type of the items.
+
+    Returns:
+        An async iterator of the chunks of the JSON array of documents.
+    """
+    internal_course_id = await convert_course_id_to_id(pool, int(course_id))
+    key = (internal_course_id, item_type)
+
+    async with pool.acquire() as conn:
+        # any write to the changes adds a row with a new id, so this identifies the stored version
+        version = tuple(await conn.fetchrow('SELECT max(id), count(*) FROM changes WHERE course_id = $1 AND item_type = $2', internal_course_id, item_type))
+        cached = history_cache.get(key)
+        if cached is not None and cached[0] == version:
+            history_cache.move_to_end(key)
+            return _json_array(cached[1])
+
+        changes = await conn.fetch('SELECT * FROM change_records WHERE item_type = $1 AND course_id = $2', item_type, internal_course_id)
+
+    return _json_array(_serialize_history(key, version, changes))
+
+
+async def get_history(pool, course_id, item_type):
+    """
+    Retrieve the history of an item type of a course.
+
+    Args:
+        pool: The connection pool to the database.
+        course_id: The Canvas ID of the course.
+        item_type: The type of the items.
+
+    Returns:
+        The documents of format_history as JSON text.
+    """
+    chunks = await get_history_chunks(pool, course_id, item_type)
+    return b''.join([chunk async for chunk in chunks]).decode()
 
-    return json.dumps(history)
+
+def _item_versions(records):
+    history = build_item_history(records, sorted(records))
+    for timestamp in sorted(history):
+        yield orjson.dumps(history[timestamp]) + b'\n'
+
+
+async def stream_item_histories(pool, course_id, item_type):
+    """
+    Stream the versions of every item of a type, one item at a time. The changes are read through a cursor,
+    so only the changes of one item are in memory at a time.
+
+    Args:
+        pool: The connection pool to the database, a connection is held until the stream ends.
+        course_id: The Canvas ID of the course.
+        item_type: The type of the items.
+
+    Yields:
+        A line of JSON for every version, by item and oldest first.
+    """
+    internal_course_id = await convert_course_id_to_id(pool, int(course_id))
+
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            records = dict()
+            changes = conn.cursor(
+                'SELECT * FROM change_records WHERE course_id = $1 AND item_type = $2 ORDER BY item_id, timestamp',
+                internal_course_id, item_type, prefetch=HISTORY_PREFETCH)
+            async for change in changes:
+                if records and change['item_id'] != next(iter(records.values()))['item_id']:
+                    for line in _item_versions(records):
+                        yield line
+                    records = dict()
+                records.setdefault(change['timestamp'], change)
+
+    if records:
+        for line in _item_versions(records):
+            yield line
+
+
+def build_snapshot(changes):
+    """
+    Reconstruct the version of every item valid at one point in time.
+
+    Args:
+        changes: Per item, the changes from the full version to start from (the newest version or a keyframe)
+            down to the version valid at that time, ordered by item and newest first.
+
+    Returns:
+        A list with the valid version of every item, deleted items are left out.
+    """
+    snapshot = []
+    entry = None
+    for change in changes:
+        if entry is None or (change['item_type'], change['item_id']) != (entry['item_type'], entry['item_id']):
+            # the first change of an item is stored in full
+            if entry is not None and entry['change_type'] != 'Deletion':
+                snapshot.append(entry)
+            entry = dict(change)
+            entry['content'] = load_diff(entry.pop('diff'))
+        else:
+            content = jsondiff.try_patch(entry['content'], load_diff(change['diff']))
+            entry = dict(change)
+            del entry['diff']
+            entry['content'] = content
+    if entry is not None and entry['change_type'] != 'Deletion':
+        snapshot.append(entry)
+
+    for entry in snapshot:
+        for key, value in entry.items():
+            if isinstance(value, datetime):
+                entry[key] = value.isoformat()
+    return snapshot
+
+
+async def get_course_snapshot(pool, course_id, timestamp, item_type=None):
+    """
+    Retrieve the state of every item of a course at a point in time. Only the changes needed to reconstruct
+    the version valid at that time are read, starting from the nearest newer full version of each item.
+
+    Args:
+        pool: The connection pool to the database.
+        course_id: The Canvas ID of the course.
+        timestamp: The point in time, naive timestamps are in the local time of the server.
+        item_type: Optionally only the items of this type.
+
+    Returns:
+        A list with the version of every item that existed at the given time.
+    """
+    internal_course_id = await convert_course_id_to_id(pool, int(course_id))
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone().replace(tzinfo=None)
+
+    async with pool.acquire() as conn:
+        changes = await conn.fetch('''
+        WITH versions AS (
+            -- the version of every item valid at the time
+            SELECT DISTINCT ON (item_type, item_id) item_type, item_id, timestamp
+            FROM changes
+            WHERE course_id = $1 AND timestamp <= $2 AND ($3::item_types IS NULL OR item_type = $3)
+            ORDER BY item_type, item_id, timestamp DESC
+        ), starts AS (
+            -- the nearest full version at or after it, a keyframe or the newest version
+            SELECT v.item_type, v.item_id, v.timestamp AS version_time, (
+                SELECT min(c.timestamp)
+                FROM changes c
+                WHERE c.course_id = $1 AND c.item_type = v.item_type AND c.item_id = v.item_id
+                    AND c.timestamp >= v.timestamp
+                    AND (c.content_hash IS NOT NULL OR NOT EXISTS (
+                        SELECT 1 FROM changes n
+                        WHERE n.course_id = $1 AND n.item_type = c.item_type AND n.item_id = c.item_id AND n.id > c.id))
+            ) AS start_time
+            FROM versions v
+        )
+        SELECT r.*
+        FROM starts s
+        JOIN change_records r
+            ON r.course_id = $1 AND r.item_type = s.item_type AND r.item_id = s.item_id
+            AND r.timestamp BETWEEN s.version_time AND s.start_time
+        ORDER BY r.item_type, r.item_id, r.timestamp DESC
+        ''', internal_course_id, timestamp, item_type)
+
+    return build_snapshot(changes)
 
 
 async def post_course(pool, course_id, course_name, course_code):
@@ -663,17 +1053,18 @@ async def post_course(pool, course_id, course_name, course_code):
     """
     try:
         async with pool.acquire() as conn:
-            course = await conn.fetchrow('SELECT * FROM courses WHERE $1 = ANY(course_ids)', int(course_id))
+            course = await conn.fetchrow('SELECT * FROM courses WHERE course_ids @> ARRAY[$1::integer]', int(course_id))
 
             if course:
                 return 405, course[0]
             try:
-                course_id = await conn.fetchval('''
+                internal_course_id = await conn.fetchval('''
                 INSERT INTO courses (course_ids, name, course_code)
                 VALUES (ARRAY[$1::integer], $2, $3)
                 RETURNING id
                 ''', int(course_id), course_name, course_code)
-                return 200, course_id
+                invalidate_course_id_cache(int(course_id))
+                return 200, internal_course_id
             except Exception as e:
                 return 500, "An error happened in the database" + str(e)
 
@@ -754,28 +1145,187 @@ async def post_change(pool, course_id, request):
         return False, "Error: Change not created" + str(e)
 
 
+async def reserve_change_ids(pool, count):
+    """
+    Reserve ids for change records that are inserted later on.
+
+    Args:
+        pool: The connection pool to the database.
+        count: The number of ids to reserve.
+
+    Returns:
+        A list of unused change ids.
+    """
+    async with pool.acquire() as conn:
+        ids = await conn.fetch('''
+        SELECT nextval(pg_get_serial_sequence('changes', 'id'))
+        FROM generate_series(1, $1)
+        ''', count)
+        return [row[0] for row in ids]
+
+
+async def write_changes(pool, changes, removed_ids, content_hashes=(), replaced=()):
+    """
+    Deletes and inserts change records in a single transaction. The full versions of changes with a content hash
+    are stored once in the snapshots table.
+
+    Args:
+        pool: The connection pool to the database.
+        changes: Tuples of (id, course_id, timestamp, item_id, change_type, item_type, older_diff, diff, content_hash,
+            chain_length, chain_bytes), with ids from reserve_change_ids.
+        removed_ids: The IDs of the changes to remove.
+        content_hashes: (content_hash, id) tuples to set on existing change records, their full versions are moved
+            to the snapshots table.
+        replaced: (removed id, new id) tuples of removed changes that are stored again as a new record. Their
+            annotations and highlights move to the new record before the removed one is deleted.
+
+    Returns:
+        A tuple containing a boolean indicating the success of the operation and the number of inserted records.
+        Nothing is written if the operation fails.
+    """
+    snapshots = [(change[8], change[7]) for change in changes if change[8] is not None]
+    changes = [change[:7] + (None,) + change[8:] if change[8] is not None else change for change in changes]
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                # a snapshot found by ON CONFLICT DO NOTHING is not pruned before the changes referring to it commit
+                await conn.execute('SELECT pg_advisory_xact_lock_shared($1)', SNAPSHOTS_LOCK)
+                if snapshots:
+                    await conn.executemany('''
+                    INSERT INTO snapshots (content_hash, body) VALUES ($1, $2)
+                    ON CONFLICT DO NOTHING
+                    ''', snapshots)
+                if changes:
+                    await conn.executemany('''
+                    INSERT INTO changes (id, course_id, timestamp, item_id, change_type, item_type, older_diff, diff, content_hash,
+                                         chain_length, chain_bytes)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
+                    ''', changes)
+                if replaced:
+                    # annotations reference the removed changes, so they are moved before the delete
+                    await conn.executemany(
+                        'UPDATE annotations SET change_id = $2 WHERE change_id = $1', replaced)
+                    await conn.executemany('''
+                    UPDATE changes SET highlights = removed.highlights
+                    FROM changes removed
+                    WHERE removed.id = $1 AND changes.id = $2
+                    ''', replaced)
+                if removed_ids:
+                    await conn.execute('DELETE FROM changes WHERE id = ANY($1::int[])', removed_ids)
+                if content_hashes:
+                    await conn.executemany('''
+                    INSERT INTO snapshots (content_hash, body)
+                    SELECT $1, diff FROM changes WHERE id = $2 AND diff IS NOT NULL
+                    ON CONFLICT DO NOTHING
+                    ''', content_hashes)
+                    await conn.executemany(
+                        'UPDATE changes SET content_hash = $1, diff = NULL WHERE id = $2', content_hashes)
+            return True, len(changes)
+    except Exception as e:
+        print(
+            "request to write_changes failed, datadump:",
+            "removed_ids:\n",
+            removed_ids,
+            "error:\n",
+            e)
+        return False, "Error: Changes not written" + str(e)
+
+
+async def copy_changes(pool, records):
+    """
+    Bulk insert change records with COPY in a single transaction. The records are copied into a temporary table
+    first, from which the full versions with a content hash are stored once in the snapshots table.
+
+    Args:
+        pool: The connection pool to the database.
+        records: An (async) iterable of (course_id, timestamp, item_id, change_type, item_type, older_diff, diff,
+            content_hash) tuples, it is consumed while the records are sent.
+
+    Returns:
+        A tuple containing a boolean indicating the success of the operation and the number of inserted records.
+        Nothing is written if the operation fails.
+    """
+    columns = ['course_id', 'timestamp', 'item_id', 'change_type', 'item_type', 'older_diff', 'diff', 'content_hash']
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('SELECT pg_advisory_xact_lock_shared($1)', SNAPSHOTS_LOCK)
+                await conn.execute(f'''
+                CREATE TEMPORARY TABLE import_changes ON COMMIT DROP AS
+                SELECT {', '.join(columns)} FROM changes WITH NO DATA
+                ''')
+                result = await conn.copy_records_to_table('import_changes', records=records, columns=columns)
+                await conn.execute('''
+                INSERT INTO snapshots (content_hash, body)
+                SELECT DISTINCT ON (content_hash) content_hash, diff
+                FROM import_changes
+                WHERE content_hash IS NOT NULL
+                ON CONFLICT DO NOTHING;
+
+                INSERT INTO changes (course_id, timestamp, item_id, change_type, item_type, older_diff, diff, content_hash)
+                SELECT course_id, timestamp, item_id, change_type, item_type, older_diff,
+                       CASE WHEN content_hash IS NULL THEN diff END, content_hash
+                FROM import_changes;
+                ''')
+            return True, int(result.split()[-1])
+    except Exception as e:
+        print("request to copy_changes failed, error:\n", e)
+        return False, "Error: Changes not copied" + str(e)
+
+
+async def prune_snapshots(pool):
+    """
+    Removes the snapshots that no change refers to anymore. It waits for the writers of changes to commit,
+    and they wait for it, so a snapshot a writer is about to refer to is never removed.
+
+    Args:
+        pool: The connection pool to the database.
+
+    Returns:
+        A tuple containing a boolean indicating the success of the operation and the number of removed snapshots.
+    """
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('SELECT pg_advisory_xact_lock($1)', SNAPSHOTS_LOCK)
+                result = await conn.execute('''
+                DELETE FROM snapshots s
+                WHERE NOT EXISTS (SELECT 1 FROM changes c WHERE c.content_hash = s.content_hash)
+                ''')
+            return True, int(result.split()[-1])
+    except Exception as e:
+        print("request to prune_snapshots failed, error:\n", e)
+        return False, "Error: Snapshots not pruned" + str(e)
+
+
 async def put_highlight(pool, course_id, change_id, request):
     """
-    Update the highlights for a change record.
+    Update the highlights for a change record. The cached histories of the course hold the highlights,
+    so they are dropped.
 
     Args:
         pool: The connection pool to the database.
-        course_id: The ID of the course.
+        course_id: The Canvas ID of the course.
         change_id: The ID of the change to update.
 
     Returns:
-        A boolean indicating the success of the operation.
+        A boolean indicating the success of the operation, False if the course has no such change.
     """
-    async with pool.acquire() as conn:
-        try:
-            await conn.execute('''
+    try:
+        internal_course_id = await convert_course_id_to_id(pool, int(course_id))
+        async with pool.acquire() as conn:
+            status = await conn.execute('''
             UPDATE changes
             SET highlights = $1
             WHERE id = $2 AND course_id = $3
-            ''', request.highlights, change_id, int(course_id))
-            return True
-        except Exception as e:
+            ''', request.highlight, change_id, internal_course_id)
+        if status == 'UPDATE 0':
             return False
+        invalidate_history_cache(internal_course_id)
+        return True
+    except Exception as e:
+        print("request to put_highlight failed, error:\n", e)
+        return False
 
 
 async def post_user(pool, course_id, user_id, email, name, role):
@@ -829,6 +1379,7 @@ async def remove_course_by_id(pool, course_id):
     async with pool.acquire() as conn:
         try:
             await conn.execute('DELETE FROM courses WHERE id = $1', int(course_id))
+            invalidate_course_id_cache(internal_course_id=int(course_id))
             return True
         except Exception as e:
             print(f"Error: {e}")
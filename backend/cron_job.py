@@ -4,9 +4,12 @@ import program as prog
 import controllers.frontend_api as fapi
 from db.get_db_conn import create_pool
 from datetime import datetime
+from os import getenv
+import jsondiff
 import json
 import asyncio
-import tempfile
+import time
+import traceback
 
 
 async def handle_course(pool, course):
@@ -32,13 +35,142 @@ async def handle_course(pool, course):
         raise Exception(f"Error: {err} - {msg}")
 
 
-async def add_change(pool, course_id, request):
-    err, msg = await fapi.post_change(pool, course_id, request)
-    if not err:
-        raise Exception(f"Error: {err} - {msg}")
+class ChangeWriter:
+    """
+    Collects the changes of one course sync and writes them in a single
+    transaction, so a crashed run leaves no half written version chains.
+    Ids are reserved from the database in blocks, which lets a new row be
+    referenced through older_diff before it is written.
+    """
+
+    def __init__(self, pool, course_id, block_size=100):
+        self._pool = pool
+        self._course_id = course_id
+        self._block_size = block_size
+        self._ids = []
+        self._changes = dict()
+        self._removed_ids = []
+        self._replaced = []
+        self._content_hashes = []
+        # diffs run and skipped because the item did not change
+        self.diffs = 0
+        self.skipped_diffs = 0
+
+    async def _next_id(self):
+        if not self._ids:
+            self._ids = await fapi.reserve_change_ids(self._pool, self._block_size)
+        return self._ids.pop(0)
+
+    async def add(self, request, index=None):
+        """
+        Queues a change and returns its id. If an index is given the new row
+        becomes the most recent change of its item in it.
+        """
+        change_id = await self._next_id()
+        older_diff = request.older_diff or None
+        self._changes[change_id] = (
+            change_id,
+            int(self._course_id),
+            request.timestamp,
+            request.item_id,
+            request.change_type,
+            request.item_type,
+            older_diff,
+            request.diff,
+            request.content_hash,
+            request.chain_length,
+            request.chain_bytes
+        )
+        if index is not None:
+            index_change(index, {
+                'id': change_id,
+                'item_id': request.item_id,
+                'course_id': self._course_id,
+                'change_type': request.change_type,
+                'timestamp': request.timestamp,
+                'item_type': request.item_type,
+                'older_diff': older_diff,
+                'diff': request.diff,
+                'highlights': None,
+                'content_hash': request.content_hash,
+                'chain_length': request.chain_length,
+                'chain_bytes': request.chain_bytes
+            })
+        return change_id
+
+    def remove(self, change_id, replaced_by=None):
+        """
+        Removes a change. If it is stored again as the change replaced_by,
+        its annotations and highlights move to that change.
+        """
+        if self._changes.pop(change_id, None) is None:
+            self._removed_ids.append(change_id)
+            if replaced_by is not None:
+                self._replaced.append((change_id, replaced_by))
+
+    def set_content_hash(self, change_id, content_hash):
+        """
+        Sets the content hash of a stored change that does not have one yet.
+        """
+        if change_id in self._changes:
+            change = self._changes[change_id]
+            self._changes[change_id] = change[:8] + (content_hash,) + change[9:]
+        else:
+            self._content_hashes.append((content_hash, change_id))
+
+    async def flush(self):
+        if not self._changes and not self._removed_ids and not self._content_hashes:
+            return
+        err, msg = await fapi.write_changes(
+            self._pool, list(self._changes.values()), self._removed_ids, self._content_hashes, self._replaced)
+        if not err:
+            raise Exception(f"Error: {err} - {msg}")
+        fapi.invalidate_history_cache(self._course_id)
+        self._changes = dict()
+        self._removed_ids = []
+        self._replaced = []
+        self._content_hashes = []
+
+
+# import new courses with COPY instead of inserting through ChangeWriter
+BULK_IMPORT = getenv('CRON_BULK_IMPORT', '1') != '0'
+
+# an older version is kept in full instead of as a reverse diff after this many
+# reverse diffs, or once the reverse diffs since the last full version are this large
+KEYFRAME_INTERVAL = int(getenv('CRON_KEYFRAME_INTERVAL', 20))
+KEYFRAME_BYTES = int(getenv('CRON_KEYFRAME_BYTES', 256 * 1024))
+
+# the canvas api methods listing the items synced for every course
+ITEM_LISTINGS = {
+    'Pages': 'get_pages',
+    'Assignments': 'get_assignments',
+    'Quizzes': 'get_quizes',
+    'Modules': 'get_modules',
+    'Sections': 'get_sections',
+}
+
+
+def get_id_key(item_type):
+    # pages for some reason have page_id instead of id
+    return 'page_id' if item_type == 'Pages' else 'id'
 
 
-async def save_new_course(pool, course, course_id, timestamp):
+async def fetch_items(api, course):
+    """
+    Fetches all listings of a course at the same time, since they do not
+    depend on each other a course costs about as long as its slowest listing.
+
+    Returns:
+        A dictionary of item type to the list of fetched canvas objects.
+    """
+    async def collect(listing):
+        return [item async for item in getattr(api, listing)(course)]
+
+    results = await asyncio.gather(*(collect(listing) for listing in ITEM_LISTINGS.values()))
+    return dict(zip(ITEM_LISTINGS, results))
+
+
+async def save_new_course(writer, course, course_id, timestamp):
     cdata = course.get_data()
     request = prog.ChangeCreate(
         item_id=cdata['id'],
@@ -47,50 +179,96 @@ async def save_new_course(pool, course, course_id, timestamp):
         timestamp=timestamp,
         item_type='Courses',
         older_diff=0,
-        diff=json.dumps(cdata)
+        diff=json.dumps(cdata),
+        content_hash=jsondiff.content_hash(cdata)
     )
 
-    await add_change(pool, course_id, request)
-
-
-# handle pages separately because they for some reason have page_id
-# instead of id
-async def save_course_pages(pool, api, course, course_id, timestamp):
-    async for page in api.get_pages(course):
-        pdata = page.get_data()
-        request = prog.ChangeCreate(
-            item_id=pdata['page_id'],
-            course_id=course_id,
-            change_type='Addition',
-            timestamp=timestamp,
-            item_type='Pages',
-            older_diff=0,
-            diff=json.dumps(pdata)
-        )
-
-        await add_change(pool, course_id, request)
+    await writer.add(request)
+    return 1
 
 
 async def save_new_items(
-        pool,
-        course,
+        writer,
+        items,
         course_id,
         item_type,
-        api_method,
         timestamp):
-    async for item in api_method(course):
+    id_key = get_id_key(item_type)
+    for item in items:
         data = item.get_data()
         request = prog.ChangeCreate(
-            item_id=data['id'],
+            item_id=data[id_key],
             course_id=course_id,
             change_type='Addition',
             timestamp=timestamp,
             item_type=item_type,
             older_diff=0,
-            diff=json.dumps(data)
+            diff=json.dumps(data),
+            content_hash=jsondiff.content_hash(data)
         )
 
-        await add_change(pool, course_id, request)
+        await writer.add(request)
+    return len(items)
+
+
+async def stream_new_course(api, course, course_id, timestamp, queue_size=1000):
+    """
+    Yields the change records of a new course for copy_changes. The listings
+    are fetched concurrently and their items are yielded as they come in.
+    """
+    cdata = course.get_data()
+    yield (int(course_id), timestamp, cdata['id'], 'Addition', 'Courses', None, json.dumps(cdata),
+           jsondiff.content_hash(cdata))
+
+    queue = asyncio.Queue(maxsize=queue_size)
+    done = object()
+
+    async def produce(item_type, listing):
+        id_key = get_id_key(item_type)
+        async for item in getattr(api, listing)(course):
+            data = item.get_data()
+            await queue.put((int(course_id), timestamp, data[id_key], 'Addition', item_type, None, json.dumps(data),
+                             jsondiff.content_hash(data)))
+
+    async def produce_all():
+        try:
+            await asyncio.gather(*(produce(item_type, listing) for item_type, listing in ITEM_LISTINGS.items()))
+        finally:
+            await queue.put(done)
+
+    producers = asyncio.create_task(produce_all())
+    try:
+        while (record := await queue.get()) is not done:
+            yield record
+        # raises the error of a failed listing, which aborts the copy
+        await producers
+    finally:
+        producers.cancel()
+
+
+async def report_progress(records, course_id, every=500):
+    count = 0
+    start = time.perf_counter()
+    async for record in records:
+        yield record
+        count += 1
+        if count % every == 0:
+            print(f"Course {course_id}: imported {count} items ({count / (time.perf_counter() - start):.1f} items/s)")
+
+
+async def import_new_course(api, pool, course, course_id, timestamp):
+    """
+    Imports all items of a new course with a single COPY into changes.
+
+    Returns:
+        The number of imported items.
+    """
+    records = stream_new_course(api, course, course_id, timestamp)
+    err, count = await fapi.copy_changes(pool, report_progress(records, course_id))
+    if not err:
+        raise Exception(f"Error: {err} - {count}")
+    fapi.invalidate_history_cache(course_id)
+    return count
 
 
 async def dir_diffs(pool, api, dir, course_id):
@@ -108,87 +286,143 @@ async def filesystem_diffs(pool, api, course, course_id):
     await dir_diffs(pool, api, dir, course_id)
 
 
-def get_most_recent_change(changes, item_type, item_id):
-    filtered_changes = [change for change in changes if change['item_id']
-                        == item_id and change['item_type'] == item_type]
-    sorted_changes = sorted(
-        filtered_changes,
-        key=lambda change: change['id'],
-        reverse=True
-    )
-    return sorted_changes[0] if sorted_changes else None
-
-
-async def get_diff(json1, json2):
-    json_diff_path = './json/json'
-    str1 = json.dumps(json1)
-    str2 = json.dumps(json2)
-    with tempfile.TemporaryFile() as f:
-        f.write(b'diff')
-        f.write(b'\n')
-        f.write(str1.encode())
-        f.write(b'\n')
-        f.write(str2.encode())
-        f.seek(0)
-
-        file_content = f.read()
-
-    process = await asyncio.create_subprocess_exec(
-        json_diff_path,
-        stdin=asyncio.subprocess.PIPE,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
-    )
+def index_change(index, change):
+    key = (change['item_type'], change['item_id'])
+    current = index.get(key)
+    if current is None or change['id'] > current['id']:
+        index[key] = change
+
 
-    output = (await process.communicate(input=file_content))[0].decode()
-    return json.loads(output.rstrip('\n'))
+def index_changes(changes):
+    """
+    Builds the index of the most recent change per (item_type, item_id),
+    once per run instead of searching all changes for every item.
+    """
+    index = dict()
+    for change in changes:
+        index_change(index, change)
+    return index
+
+
+def get_most_recent_change(index, item_type, item_id):
+    return index.get((item_type, item_id))
+
+
+async def save_modification(
+        writer,
+        data,
+        item_id,
+        item_type,
+        course_id,
+        most_recent_version,
+        diff,
+        timestamp,
+        index,
+        content_hash=None):
+    older_diff = most_recent_version['older_diff'] if most_recent_version['older_diff'] else 0
+    reverse_diff = json.dumps(diff)
+    chain_length = most_recent_version['chain_length'] + 1
+    chain_bytes = most_recent_version['chain_bytes'] + len(reverse_diff)
+    if chain_length >= KEYFRAME_INTERVAL or chain_bytes >= KEYFRAME_BYTES:
+        # keep the replaced version in full, reads of older versions start from it
+        older_hash = most_recent_version['content_hash']
+        if older_hash is None:
+            older_hash = jsondiff.content_hash(fapi.load_diff(most_recent_version['diff']))
+        request = prog.ChangeCreate(
+            item_id=item_id,
+            course_id=course_id,
+            change_type=most_recent_version['change_type'],
+            timestamp=most_recent_version['timestamp'],
+            item_type=item_type,
+            older_diff=older_diff,
+            diff=fapi.dump_diff(most_recent_version['diff']),
+            content_hash=older_hash
+        )
+        chain_length = chain_bytes = 0
+    else:
+        request = prog.ChangeCreate(
+            item_id=item_id,
+            course_id=course_id,
+            change_type=most_recent_version['change_type'],
+            timestamp=most_recent_version['timestamp'],
+            item_type=item_type,
+            older_diff=older_diff,
+            diff=reverse_diff
+        )
+    new_diff_id = await writer.add(request)
+    # the replaced version is stored again as new_diff_id
+    writer.remove(most_recent_version['id'], new_diff_id)
+    request = prog.ChangeCreate(
+        item_id=item_id,
+        course_id=course_id,
+        change_type='Modification',
+        timestamp=timestamp,
+        item_type=item_type,
+        older_diff=new_diff_id,
+        diff=json.dumps(data),
+        content_hash=content_hash,
+        chain_length=chain_length,
+        chain_bytes=chain_bytes
+    )
+    await writer.add(request, index)
 
 
-async def page_diffs(pool, api, course, changes, course_id, timestamp):
-    async for item in api.get_pages(course):
+async def process_item_diffs(
+        writer,
+        items,
+        item_type,
+        course_id,
+        index,
+        timestamp):
+    """
+    Stores new items and the changes of existing items, all items of the
+    batch are diffed against their stored versions at once. Items canvas
+    reported as unchanged, or with the content hash of their stored version,
+    are not diffed.
+    """
+    id_key = get_id_key(item_type)
+    existing = []
+    pairs = []
+    for item in items:
         data = item.get_data()
         most_recent_version = get_most_recent_change(
-            changes, 'Pages', data['page_id'])
+            index, item_type, data[id_key])
+        if most_recent_version is not None and item.is_unchanged():
+            # canvas answered 304 Not Modified, the stored version is current
+            writer.skipped_diffs += 1
+            continue
+        content_hash = jsondiff.content_hash(data)
         if most_recent_version is None:
             request = prog.ChangeCreate(
-                item_id=data['page_id'],
+                item_id=data[id_key],
                 course_id=course_id,
                 change_type='Addition',
                 timestamp=timestamp,
-                item_type='Pages',
+                item_type=item_type,
                 older_diff=0,
-                diff=json.dumps(data)
+                diff=json.dumps(data),
+                content_hash=content_hash
             )
-            await add_change(pool, course_id, request)
-
+            await writer.add(request, index)
+        elif most_recent_version['content_hash'] == content_hash:
+            writer.skipped_diffs += 1
         else:
-            diff = await get_diff(data, json.loads(most_recent_version['diff']))
-            if diff:
-                older_diff = most_recent_version['older_diff'] if most_recent_version['older_diff'] else 0
-                await fapi.remove_change_by_id(pool, most_recent_version['id'])
-                request = prog.ChangeCreate(
-                    item_id=data['page_id'],
-                    course_id=course_id,
-                    change_type=most_recent_version['change_type'],
-                    timestamp=most_recent_version['timestamp'],
-                    item_type='Pages',
-                    older_diff=older_diff,
-                    diff=json.dumps(diff)
-                )
-                await add_change(pool, course_id, request)
-                changes = await fapi.get_changes_by_courseid(pool, course_id)
-                new_diff_id = get_most_recent_change(
-                    changes, 'Pages', data['page_id'])['id']
-                request = prog.ChangeCreate(
-                    item_id=data['page_id'],
-                    course_id=course_id,
-                    change_type='Modification',
-                    timestamp=timestamp,
-                    item_type='Pages',
-                    older_diff=new_diff_id,
-                    diff=json.dumps(data)
-                )
-                await add_change(pool, course_id, request)
+            existing.append((data, most_recent_version, content_hash))
+            pairs.append((data, fapi.load_diff(most_recent_version['diff'])))
+
+    diffs = await jsondiff.diff_many(pairs)
+    writer.diffs += len(diffs)
+    for (data, most_recent_version, content_hash), diff in zip(existing, diffs):
+        if diff is None:
+            # the job failed in a ./json/json worker, the stored version is left for the next run to diff again
+            print(f"Error: could not diff {item_type} {data[id_key]}")
+        elif diff:
+            await save_modification(writer, data, data[id_key], item_type, course_id, most_recent_version, diff,
+                                    timestamp, index, content_hash)
+        elif most_recent_version['content_hash'] is None:
+            # stored before content hashes, the next run can skip the diff
+            writer.set_content_hash(most_recent_version['id'], content_hash)
+    return len(items)
 
 
 async def process_item_diff(
@@ -196,114 +430,161 @@ async def process_item_diff(
         item,
         item_type,
         course_id,
-        changes,
+        index,
         timestamp):
-    data = item.get_data()
-    most_recent_version = get_most_recent_change(
-        changes, item_type, data['id'])
-    if most_recent_version is None:
-        request = prog.ChangeCreate(
-            item_id=data['id'],
-            course_id=course_id,
-            change_type='Addition',
-            timestamp=timestamp,
-            item_type=item_type,
-            older_diff=0,
-            diff=json.dumps(data)
-        )
-        await add_change(pool, course_id, request)
-    else:
-        diff = await get_diff(data, json.loads(most_recent_version['diff']))
-        if diff:
-            older_diff = most_recent_version['older_diff'] if most_recent_version['older_diff'] else 0
-            await fapi.remove_change_by_id(pool, most_recent_version['id'])
-            request = prog.ChangeCreate(
-                item_id=data['id'],
-                course_id=course_id,
-                change_type=most_recent_version['change_type'],
-                timestamp=most_recent_version['timestamp'],
-                item_type=item_type,
-                older_diff=older_diff,
-                diff=json.dumps(diff)
-            )
-            await add_change(pool, course_id, request)
-            changes = await fapi.get_changes_by_courseid(pool, course_id)
-            new_diff_id = get_most_recent_change(
-                changes, item_type, data['id'])['id']
-            request = prog.ChangeCreate(
-                item_id=data['id'],
-                course_id=course_id,
-                change_type='Modification',
-                timestamp=timestamp,
-                item_type=item_type,
-                older_diff=new_diff_id,
-                diff=json.dumps(data)
-            )
-            await add_change(pool, course_id, request)
-
+    writer = ChangeWriter(pool, course_id)
+    count = await process_item_diffs(writer, [item], item_type, course_id, index, timestamp)
+    await writer.flush()
+    return count
 
-async def calc_diffs(pool, api, course, changes, course_id, timestamp):
-    await process_item_diff(pool, course, 'Courses', course_id, changes, timestamp)
 
-    async for item in api.get_assignments(course):
-        await process_item_diff(pool, item, 'Assignments', course_id, changes, timestamp)
+async def calc_diffs(writer, course, items, index, course_id, timestamp):
+    count = await process_item_diffs(writer, [course], 'Courses', course_id, index, timestamp)
+    for item_type, type_items in items.items():
+        count += await process_item_diffs(writer, type_items, item_type, course_id, index, timestamp)
+    return count
 
-    async for item in api.get_quizes(course):
-        await process_item_diff(pool, item, 'Quizzes', course_id, changes, timestamp)
 
-    async for item in api.get_modules(course):
-        await process_item_diff(pool, item, 'Modules', course_id, changes, timestamp)
+async def cron_job(api, pool, course, stats=None):
+    """
+    Syncs a single course.
 
-    async for item in api.get_sections(course):
-        await process_item_diff(pool, item, 'Sections', course_id, changes, timestamp)
+    Args:
+        api: The canvas api object.
+        pool: The connection pool to the database.
+        course: The canvas course object.
+        stats: An optional dictionary in which the numbers of diffs run
+            and skipped are added up.
 
-
-async def cron_job(api, pool, course):
+    Returns:
+        The number of items that were fetched from canvas.
+    """
     course_id, is_new = await handle_course(pool, course)
     timestamp = datetime.now()
     print(f"Course: {course_id}")
     print(f"New: {is_new}")
-    if is_new:
-        await save_new_course(pool, course, course_id, timestamp)
-
-        # handle pages separately because they for some reason have
-        # page_id instead of id
-        await save_course_pages(pool, api, course, course_id, timestamp)
-        await save_new_items(pool, course, course_id, 'Assignments', api.get_assignments, timestamp)
-        await save_new_items(pool, course, course_id, 'Quizzes', api.get_quizes, timestamp)
-        await save_new_items(pool, course, course_id, 'Modules', api.get_modules, timestamp)
-        await save_new_items(pool, course, course_id, 'Sections', api.get_sections, timestamp)
+    if is_new and BULK_IMPORT:
+        count = await import_new_course(api, pool, course, course_id, timestamp)
         print("New course added")
     else:
-        changes = await fapi.get_changes_by_courseid(pool, course_id)
-
-        # handle pages separately because they for some reason have
-        # page_id instead of id
-        await page_diffs(pool, api, course, changes, course_id, timestamp)
-        await calc_diffs(pool, api, course, changes, course_id, timestamp)
-        print("Course updated")
-
-
-async def cron_job_by_course_id(course_id):
-    async with connection.ManualCanvasConnection.make_from_environment() as conn:
-        api = canvasapi.Canvas(conn)
-        pool = await create_pool()
-
-        course = await canvasapi.Course(api).set_id(course_id).resolve()
-        await cron_job(api, pool, course)
-
-        await pool.close()
+        items = await fetch_items(api, course)
+        writer = ChangeWriter(pool, course_id)
+        if is_new:
+            count = await save_new_course(writer, course, course_id, timestamp)
+            for item_type, type_items in items.items():
+                count += await save_new_items(writer, type_items, course_id, item_type, timestamp)
+            await writer.flush()
+            print("New course added")
+        else:
+            index = index_changes(await fapi.get_latest_changes_by_courseid(pool, course_id))
+            count = await calc_diffs(writer, course, items, index, course_id, timestamp)
+            await writer.flush()
+            print(f"Course updated, {writer.diffs} diffs, {writer.skipped_diffs} skipped")
+            if stats is not None:
+                stats['diffs'] = stats.get('diffs', 0) + writer.diffs
+                stats['skipped_diffs'] = stats.get('skipped_diffs', 0) + writer.skipped_diffs
+
+    # the responses are stored, so canvas may report them as unchanged next time
+    api.get_connection().commit_validators(f"/api/v1/courses/{course.get_id()}")
+    return count
+
+
+async def cron_job_by_course_id(conn, pool, course_id):
+    """
+    Syncs a single course over an existing canvas connection and database pool.
+    """
+    api = canvasapi.Canvas(conn)
+    course = await canvasapi.Course(api).set_id(course_id).resolve()
+    return await cron_job(api, pool, course)
+
+
+async def sync_course(api, pool, course, semaphore, timeout, stats):
+    async with semaphore:
+        start = time.perf_counter()
+        result = {'course': course.get_id(), 'items': 0, 'error': None}
+        try:
+            result['items'] = await asyncio.wait_for(cron_job(api, pool, course, stats), timeout)
+        except Exception as e:
+            # a failing course should not stop the others from syncing
+            result['error'] = repr(e)
+            traceback.print_exc()
+        result['duration'] = time.perf_counter() - start
+        return result
+
+
+def print_sync_report(results, elapsed, stats):
+    items = sum(result['items'] for result in results)
+    failed = [result for result in results if result['error'] is not None]
+    print(f"Synced {len(results) - len(failed)}/{len(results)} courses, "
+          f"{items} items in {elapsed:.2f}s ({items / elapsed if elapsed else 0:.1f} items/s)")
+    print(f"Diffed {stats.get('diffs', 0)} items, skipped {stats.get('skipped_diffs', 0)} unchanged items")
+    for result in sorted(results, key=lambda r: r['duration'], reverse=True):
+        status = f"failed: {result['error']}" if result['error'] else f"{result['items']} items"
+        print(f"  Course {result['course']}: {result['duration']:.2f}s, {status}")
+
+
+async def sync_courses(api, pool, courses, concurrency=4, timeout=None):
+    """
+    Syncs courses concurrently.
+
+    Args:
+        api: The canvas api object.
+        pool: The connection pool to the database.
+        courses: The canvas course objects to sync.
+        concurrency: The maximum number of courses synced at the same time.
+        timeout: The maximum number of seconds a single course may take.
+
+    Returns:
+        A result dictionary per course, with the number of items, the
+        duration in seconds and the error if the course failed.
+    """
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    stats = dict()
+    start = time.perf_counter()
+    results = await asyncio.gather(*(
+        sync_course(api, pool, course, semaphore, timeout, stats) for course in courses
+    ))
+    print_sync_report(results, time.perf_counter() - start, stats)
+    return results
 
 
 async def main():
-    async with connection.ManualCanvasConnection.make_from_environment() as conn:
-        api = canvasapi.Canvas(conn)
+    # number of long running ./json/json workers, 0 diffs in-process
+    workers = int(getenv('JSON_DIFF_WORKERS', 0))
+    async with connection.ManualCanvasConnection.make_from_environment(validators=True) as conn, \
+            jsondiff.JsonWorkerPool(workers) as worker_pool:
+        # decode list pages while they arrive instead of prefetching them,
+        # those pages are then downloaded in full on every run
+        api = canvasapi.Canvas(conn, stream_lists=getenv('CANVAS_STREAM_LISTS', '0') == '1')
+        if workers:
+            jsondiff.set_worker_pool(worker_pool)
 
         pool = await create_pool()
-        async for course in api.get_courses():
-            await cron_job(api, pool, course)
+        courses = [course async for course in api.get_courses()]
+        results = await sync_courses(
+            api,
+            pool,
+            courses,
+            concurrency=int(getenv('CRON_CONCURRENCY', 4)),
+            timeout=float(getenv('CRON_COURSE_TIMEOUT', 0)) or None
+        )
+        if all(result['error'] is None for result in results):
+            # the course rows come from the course list
+            conn.commit_validators('/api/v1/courses')
+
+        # versions replaced during the sync can leave snapshots unused
+        err, pruned = await fapi.prune_snapshots(pool)
+        if err:
+            print(f"Removed {pruned} unused snapshots")
+        print(f"Canvas requests: {conn.get_stats()}")
+        db_stats = pool.get_stats()
+        queries = db_stats.pop('queries')
+        print(f"Database: {db_stats}")
+        for query, stats in list(queries.items())[:5]:
+            print(f"  {stats['total']:.3f}s in {stats['count']} queries: {query[:100]}")
 
         await pool.close()
+        jsondiff.set_worker_pool(None)
 
 
 if __name__ == "__main__":
@@ -1,4 +1,6 @@
 import asyncpg
+import orjson
+import time
 from dotenv import load_dotenv
 from os import getenv, path
 
@@ -12,30 +14,170 @@ db_params = {
     'password': getenv('DB_PASSWORD'),
     'host': getenv('DB_HOST'),
     'port': getenv('DB_PORT'),
-    'database': 'postgres'  # connect to default database to execute CREATE DATABASE command
+    'database': getenv('DB_NAME', 'postgres')
+}
+
+# connect to the default database to execute the CREATE DATABASE command
+admin_params = dict(db_params, database='postgres')
+
+# The pool settings, the defaults are the ones of asyncpg. A command timeout of 0 disables it.
+pool_params = {
+    'min_size': int(getenv('DB_POOL_MIN_SIZE', 10)),
+    'max_size': int(getenv('DB_POOL_MAX_SIZE', 10)),
+    'max_queries': int(getenv('DB_POOL_MAX_QUERIES', 50000)),
+    'max_inactive_connection_lifetime': float(getenv('DB_POOL_MAX_INACTIVE_LIFETIME', 300)),
+    'statement_cache_size': int(getenv('DB_STATEMENT_CACHE_SIZE', 100)),
+    'command_timeout': float(getenv('DB_COMMAND_TIMEOUT', 0)) or None,
+    'timeout': float(getenv('DB_CONNECT_TIMEOUT', 60))
 }
 
 
 async def get_db_conn():
+    # Check if database exists, it can't be created from within a connection to itself
+    conn = await asyncpg.connect(**admin_params)
+    try:
+        exists = await conn.fetchrow("SELECT 1 FROM pg_catalog.pg_database WHERE datname = $1", db_params['database'])
+        if not exists:
+            await conn.execute(f"CREATE DATABASE {db_params['database']}")
+    finally:
+        await conn.close()
+
     # Connect to your postgres DB
-    conn = await asyncpg.connect(**db_params)
+    return await asyncpg.connect(**db_params)
 
-    # Check if database exists
-    exists = await conn.fetchrow("SELECT 1 FROM pg_catalog.pg_database WHERE datname = $1", getenv('DB_NAME'))
-    if not exists:
-        # Can't create database from within another connection, so disconnect
-        await conn.close()
 
-        # Connect to the default database to create the new database
-        conn = await asyncpg.connect(**db_params)
-        await conn.execute(f"CREATE DATABASE {getenv('DB_NAME')}")
+def encode_jsonb(value):
+    # strings are sent as JSON text, so the same values can be written to TEXT and JSONB columns
+    return b'\x01' + (value.encode() if isinstance(value, str) else orjson.dumps(value))
+
+
+def decode_jsonb(data):
+    # the binary format is a version byte followed by the JSON text
+    return orjson.loads(data[1:])
+
+
+class PoolMetrics:
+    """
+    Collects how long requests wait for a connection of the pool and how long every query takes.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.acquires = 0
+        self.acquire_wait = 0.0
+        self.max_acquire_wait = 0.0
+        self.queries = {}
+
+    def record_acquire(self, elapsed):
+        self.acquires += 1
+        self.acquire_wait += elapsed
+        self.max_acquire_wait = max(self.max_acquire_wait, elapsed)
+
+    def record_query(self, record):
+        # a query logger of asyncpg, the parameters are left out so every statement is counted once
+        query = ' '.join(record.query.split())
+        stats = self.queries.get(query)
+        if stats is None:
+            stats = self.queries[query] = {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0}
+        stats['count'] += 1
+        stats['errors'] += record.exception is not None
+        stats['total'] += record.elapsed
+        stats['max'] = max(stats['max'], record.elapsed)
+
+    def get_stats(self):
+        return {
+            'acquires': self.acquires,
+            'acquire_wait': self.acquire_wait,
+            'max_acquire_wait': self.max_acquire_wait,
+            'queries': {
+                query: dict(stats, mean=stats['total'] / stats['count'])
+                for query, stats in sorted(self.queries.items(), key=lambda item: item[1]['total'], reverse=True)
+            }
+        }
+
+
+class _MeteredAcquire:
+    # like the context of asyncpg, it can be awaited or used with async with
+    def __init__(self, pool, timeout):
+        self._pool = pool
+        self._timeout = timeout
+        self._conn = None
+
+    async def _acquire(self):
+        self._pool.waiting += 1
+        start = time.perf_counter()
+        try:
+            return await self._pool.pool.acquire(timeout=self._timeout)
+        finally:
+            self._pool.waiting -= 1
+            self._pool.metrics.record_acquire(time.perf_counter() - start)
+
+    def __await__(self):
+        return self._acquire().__await__()
+
+    async def __aenter__(self):
+        self._conn = await self._acquire()
+        return self._conn
+
+    async def __aexit__(self, *_):
+        conn, self._conn = self._conn, None
+        await self._pool.pool.release(conn)
+
+
+class MeteredPool:
+    """
+    An asyncpg pool that keeps PoolMetrics. Acquiring a connection is timed here, the queries are timed by a query
+    logger on every connection. Everything else is passed on to the pool.
+    """
+
+    def __init__(self, pool, metrics):
+        self.pool = pool
+        self.metrics = metrics
+        self.waiting = 0
+
+    def acquire(self, *, timeout=None):
+        return _MeteredAcquire(self, timeout)
+
+    def get_stats(self):
+        """
+        Gets the size of the pool, the number of connections in use and waited for and the metrics.
+        """
+        size = self.pool.get_size()
+        return dict(
+            self.metrics.get_stats(),
+            size=size,
+            max_size=self.pool.get_max_size(),
+            in_use=size - self.pool.get_idle_size(),
+            waiting=self.waiting
+        )
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
 
-    return conn
+async def init_connection(conn, metrics=None):
+    '''Registers the codecs of a new connection, JSONB values are decoded by orjson into Python objects.'''
+    await conn.set_type_codec(
+        'jsonb',
+        schema='pg_catalog',
+        encoder=encode_jsonb,
+        decoder=decode_jsonb,
+        format='binary'
+    )
+    if metrics is not None:
+        conn.add_query_logger(metrics.record_query)
 
 
 async def create_pool():
-    pool = await asyncpg.create_pool(**db_params)
-    return pool
+    metrics = PoolMetrics()
+    pool = await asyncpg.create_pool(
+        **db_params,
+        **pool_params,
+        init=lambda conn: init_connection(conn, metrics)
+    )
+    return MeteredPool(pool, metrics)
 
 
 if __name__ == '__main__':
@@ -3,6 +3,14 @@ from get_db_conn import get_db_conn
 # Warning Do not run this script unless you want to destroy the existing tables and recreate them.
 # This script is used to create the tables in the database. It will first
 # drop the existing tables if destroy_existing_tables is True.
+# Run it as 'python init_db.py upgrade' to only bring an existing database up to date,
+# and as 'python init_db.py jsonb' to convert the stored diffs of an existing database to JSONB.
+#
+# The tables are created in the database named by DB_NAME. Older versions created them in the default
+# 'postgres' database whatever DB_NAME was, and the application read them from there. To keep the data of
+# such an install, either set DB_NAME=postgres, or copy the tables over before starting the application:
+#   pg_dump -d postgres -n public | psql -d "$DB_NAME"
+# and then run 'python init_db.py upgrade'.
 
 
 async def create_tables(destroy_existing_tables=False):
@@ -13,7 +21,9 @@ async def create_tables(destroy_existing_tables=False):
         DROP TABLE IF EXISTS teacher_courses CASCADE;
         DROP TABLE IF EXISTS users CASCADE;
         DROP TABLE IF EXISTS courses CASCADE;
+        DROP VIEW IF EXISTS change_records CASCADE;
         DROP TABLE IF EXISTS changes CASCADE;
+        DROP TABLE IF EXISTS snapshots CASCADE;
         DROP TABLE IF EXISTS annotations CASCADE;
 
 
@@ -47,6 +57,12 @@ async def create_tables(destroy_existing_tables=False):
         PRIMARY KEY (user_id, course_id)
     );
 
+    -- full versions of items, shared by all changes with the same content
+    CREATE TABLE IF NOT EXISTS snapshots (
+        content_hash TEXT PRIMARY KEY,
+        body JSONB NOT NULL
+    );
+
     CREATE TABLE IF NOT EXISTS changes (
         id SERIAL PRIMARY KEY,
         item_id INT NOT NULL,
@@ -55,8 +71,11 @@ async def create_tables(destroy_existing_tables=False):
         timestamp TIMESTAMP NOT NULL,
         item_type item_types NOT NULL,
         older_diff INT REFERENCES changes(id) NULL,
-        diff TEXT NOT NULL,
-        highlights TEXT
+        diff JSONB NULL,
+        highlights TEXT,
+        content_hash TEXT REFERENCES snapshots(content_hash) NULL,
+        chain_length INT NOT NULL DEFAULT 0,
+        chain_bytes INT NOT NULL DEFAULT 0
     );
 
     CREATE TABLE IF NOT EXISTS annotations (
@@ -70,9 +89,112 @@ async def create_tables(destroy_existing_tables=False):
     );
     ''')
 
+    await create_views(conn)
+    await create_indexes(conn)
+    await conn.close()
+
+
+async def upgrade_tables():
+    '''Brings the tables of an existing database up to date with create_tables, without losing its data.'''
+    conn = await get_db_conn()
+    async with conn.transaction():
+        await migrate_tables(conn)
+        await create_views(conn)
+    await create_indexes(conn)
     await conn.close()
 
+
+async def migrate_tables(conn):
+    '''Adds the columns that were added to the tables after they were first created.'''
+    await conn.execute('''
+    -- hash of the full version of a change, see jsondiff.content_hash
+    ALTER TABLE changes ADD COLUMN IF NOT EXISTS content_hash TEXT;
+
+    -- full versions with a hash are moved to the shared snapshots
+    CREATE TABLE IF NOT EXISTS snapshots (
+        content_hash TEXT PRIMARY KEY,
+        body TEXT NOT NULL
+    );
+    ALTER TABLE changes ALTER COLUMN diff DROP NOT NULL;
+    INSERT INTO snapshots (content_hash, body)
+        SELECT DISTINCT ON (content_hash) content_hash, diff
+        FROM changes
+        WHERE content_hash IS NOT NULL AND diff IS NOT NULL
+        ON CONFLICT DO NOTHING;
+    UPDATE changes SET diff = NULL WHERE content_hash IS NOT NULL AND diff IS NOT NULL;
+    ALTER TABLE changes DROP CONSTRAINT IF EXISTS changes_content_hash_fkey;
+    ALTER TABLE changes ADD CONSTRAINT changes_content_hash_fkey
+        FOREIGN KEY (content_hash) REFERENCES snapshots(content_hash);
+
+    -- reverse diffs behind the newest version since the last keyframe, see cron_job.save_modification
+    ALTER TABLE changes ADD COLUMN IF NOT EXISTS chain_length INT NOT NULL DEFAULT 0;
+    ALTER TABLE changes ADD COLUMN IF NOT EXISTS chain_bytes INT NOT NULL DEFAULT 0;
+    ''')
+
+
+async def convert_to_jsonb():
+    '''Converts the diffs and snapshots of an existing database from TEXT to JSONB. This rewrites both tables,
+       values are compressed with lz4 instead of pglz if the server supports it.'''
+    conn = await get_db_conn()
+    compression = await conn.fetchval('''
+    SELECT 'lz4' = ANY(enumvals) FROM pg_settings WHERE name = 'default_toast_compression'
+    ''')
+    compress = ', ALTER COLUMN {} SET COMPRESSION lz4' if compression else ''
+    async with conn.transaction():
+        # the view depends on the types of the columns
+        await conn.execute('DROP VIEW IF EXISTS change_records')
+        await conn.execute(
+            'ALTER TABLE changes ALTER COLUMN diff TYPE JSONB USING diff::jsonb' + compress.format('diff'))
+        await conn.execute(
+            'ALTER TABLE snapshots ALTER COLUMN body TYPE JSONB USING body::jsonb' + compress.format('body'))
+        await create_views(conn)
+    await conn.close()
+
+
+async def create_views(conn):
+    '''Creates the views used to read the tables.'''
+    await conn.execute('''
+    -- changes with the full versions of the snapshots in diff, changes are read through this view
+    CREATE OR REPLACE VIEW change_records AS
+        SELECT c.id, c.item_id, c.course_id, c.change_type, c.timestamp, c.item_type, c.older_diff,
+               COALESCE(c.diff, s.body) AS diff, c.highlights, c.content_hash, c.chain_length, c.chain_bytes
+        FROM changes c
+        LEFT JOIN snapshots s ON c.diff IS NULL AND s.content_hash = c.content_hash;
+    ''')
+
+
+async def create_indexes(conn):
+    '''Creates the indexes used by the queries of the application. Existing indexes are kept,
+       so this can also be run on a database that already has its tables.'''
+    await conn.execute('''
+    -- newest change per item of a course, see get_latest_changes_by_courseid
+    CREATE INDEX IF NOT EXISTS changes_latest_idx
+        ON changes (course_id, item_type, item_id, id DESC);
+
+    -- courses by canvas course id, see convert_course_id_to_id
+    CREATE INDEX IF NOT EXISTS courses_course_ids_idx
+        ON courses USING GIN (course_ids);
+
+    -- changes of a course up to a point in time, see get_course_snapshot, and pages of the change feed,
+    -- see get_change_feed. It covers the former index on (course_id, timestamp).
+    DROP INDEX IF EXISTS changes_timestamp_idx;
+    CREATE INDEX IF NOT EXISTS changes_feed_idx
+        ON changes (course_id, timestamp, id);
+
+    -- changes referencing a snapshot, see prune_snapshots
+    CREATE INDEX IF NOT EXISTS changes_content_hash_idx
+        ON changes (content_hash);
+    ''')
+
 if __name__ == '__main__':
     import asyncio
-    asyncio.run(create_tables(True))
-    print('Tables created successfully.')
+    import sys
+    if sys.argv[1:] == ['upgrade']:
+        asyncio.run(upgrade_tables())
+        print('Tables upgraded successfully.')
+    elif sys.argv[1:] == ['jsonb']:
+        asyncio.run(convert_to_jsonb())
+        print('Diffs converted to JSONB successfully.')
+    else:
+        asyncio.run(create_tables(True))
+        print('Tables created successfully.')
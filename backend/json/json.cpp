@@ -28,28 +28,43 @@ json patch(json const& j, json const& patch) {
     return j.patch(patch);
 }
 
+// Reads jobs of three lines (mode, json1, json2) until stdin is closed and
+// answers every job with exactly one line. A failed job answers with an empty
+// line, so a long running worker can keep serving the jobs after it.
 int main() {
-    std::string mode_str;
-    std::getline(std::cin, mode_str);
-    Mode mode = parseMode(mode_str);
+    std::ios::sync_with_stdio(false);
 
-    std::string line;
-    std::getline(std::cin, line);
-    json j1 = json::parse(line);
+    std::string mode_str;
+    std::string line1;
+    std::string line2;
+    while (std::getline(std::cin, mode_str)) {
+        if (!std::getline(std::cin, line1) || !std::getline(std::cin, line2)) {
+            break;
+        }
 
-    std::getline(std::cin, line);
-    json j2 = json::parse(line);
+        try {
+            Mode mode = parseMode(mode_str);
+            json j1 = json::parse(line1);
+            json j2 = json::parse(line2);
 
-    switch (mode) {
-        case Mode::DIFF: {
-            json diff = json::diff(j1, j2);
-            std::cout << diff.dump() << std::endl;
-            break;
+            switch (mode) {
+                case Mode::DIFF: {
+                    std::cout << diff(j1, j2).dump();
+                    break;
+                }
+                case Mode::PATCH: {
+                    std::cout << patch(j1, j2).dump();
+                    break;
+                }
+            }
+        } catch (std::exception const& e) {
+            std::cerr << e.what() << std::endl;
         }
-        case Mode::PATCH: {
-            json patched = patch(j1, j2);
-            std::cout << patched.dump() << std::endl;
-            break;
+        std::cout << '\n';
+
+        // only flush once the queued jobs are answered
+        if (std::cin.rdbuf()->in_avail() <= 0) {
+            std::cout.flush();
         }
     }
 }
@@ -0,0 +1,423 @@
+"""
+In-process JSON diff/patch engine (RFC 6902).
+
+This replaces spawning the compiled ./json/json tool for every comparison.
+The output follows nlohmann::json::diff and nlohmann::json::patch, which is
+what the binary uses, so diffs already stored in the changes table stay
+interchangeable with the ones produced here.
+
+For the batch functions the binary can still be used instead, through a
+JsonWorkerPool of long running ./json/json processes.
+"""
+import asyncio
+import hashlib
+import json
+import orjson
+import os
+
+
+JSON_BINARY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'json', 'json')
+
+# asyncio's default of 64 KiB per line is too small for large pages
+_LINE_LIMIT = 1 << 30
+
+
+class JsonPatchError(ValueError):
+    """
+    Raised when a patch can not be applied to a document.
+    """
+
+    pass
+
+
+class JsonWorkerError(RuntimeError):
+    """
+    Raised when a ./json/json worker process stops unexpectedly.
+    """
+
+    pass
+
+
+def _escape(key: str) -> str:
+    return key.replace("~", "~0").replace("/", "~1")
+
+
+def _unescape(token: str) -> str:
+    i = token.find("~")
+    while i != -1:
+        if i + 1 >= len(token) or token[i + 1] not in "01":
+            raise JsonPatchError(f"Invalid escape sequence in '{token}'")
+        i = token.find("~", i + 2)
+    return token.replace("~1", "/").replace("~0", "~")
+
+
+def _equal(a, b) -> bool:
+    # Python considers True == 1, nlohmann::json does not.
+    if isinstance(a, bool) or isinstance(b, bool):
+        return type(a) is type(b) and a == b
+    if isinstance(a, dict):
+        if not isinstance(b, dict) or a.keys() != b.keys():
+            return False
+        return all(_equal(value, b[key]) for key, value in a.items())
+    if isinstance(a, list):
+        if not isinstance(b, list) or len(a) != len(b):
+            return False
+        return all(_equal(x, y) for x, y in zip(a, b))
+    if isinstance(b, (dict, list)):
+        return False
+    return a == b
+
+
+def _diff(source, target, path: str, result: list) -> None:
+    if isinstance(source, dict) and isinstance(target, dict):
+        # nlohmann::json keeps object keys sorted, so walk them sorted too.
+        for key in sorted(source):
+            path_key = f"{path}/{_escape(key)}"
+            if key in target:
+                _diff(source[key], target[key], path_key, result)
+            else:
+                result.append({"op": "remove", "path": path_key})
+        for key in sorted(target):
+            if key not in source:
+                result.append({
+                    "op": "add",
+                    "path": f"{path}/{_escape(key)}",
+                    "value": target[key]
+                })
+
+    elif isinstance(source, list) and isinstance(target, list):
+        common = min(len(source), len(target))
+        for i in range(common):
+            _diff(source[i], target[i], f"{path}/{i}", result)
+        # remove trailing elements from the back to keep indices valid
+        for i in range(len(source) - 1, common - 1, -1):
+            result.append({"op": "remove", "path": f"{path}/{i}"})
+        for i in range(common, len(target)):
+            result.append({"op": "add", "path": f"{path}/-", "value": target[i]})
+
+    elif not _equal(source, target):
+        result.append({"op": "replace", "path": path, "value": target})
+
+
+def diff(source, target) -> list:
+    """
+    Creates a JSON patch that turns source into target.
+
+    Args:
+        source: The parsed JSON document to start from.
+        target: The parsed JSON document to end up with.
+
+    Returns:
+        A list of RFC 6902 operations, empty if both documents are equal.
+    """
+    result = []
+    _diff(source, target, "", result)
+    return result
+
+
+def content_hash(document) -> str:
+    """
+    Hashes the canonical form of a document, with sorted object keys.
+    Documents with equal hashes have an empty diff.
+
+    Args:
+        document: The parsed JSON document.
+
+    Returns:
+        The BLAKE2b digest as a hex string of 32 characters.
+    """
+    canonical = orjson.dumps(document, option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(canonical, digest_size=16).hexdigest()
+
+
+def _split_pointer(pointer: str) -> list:
+    if pointer == "":
+        return []
+    if not pointer.startswith("/"):
+        raise JsonPatchError(f"JSON pointer must be empty or begin with '/': '{pointer}'")
+    return [_unescape(token) for token in pointer[1:].split("/")]
+
+
+def _array_index(token: str, array: list, allow_end: bool = False) -> int:
+    if allow_end and token == "-":
+        return len(array)
+    if not token.isdigit() or not token.isascii() or (len(token) > 1 and token[0] == "0"):
+        raise JsonPatchError(f"Invalid array index: '{token}'")
+    return int(token)
+
+
+def _resolve(document, tokens: list):
+    for token in tokens:
+        if isinstance(document, dict):
+            if token not in document:
+                raise JsonPatchError(f"Key '{token}' not found")
+            document = document[token]
+        elif isinstance(document, list):
+            index = _array_index(token, document)
+            if index >= len(document):
+                raise JsonPatchError(f"Array index {index} is out of range")
+            document = document[index]
+        else:
+            raise JsonPatchError(f"Can not resolve '{token}' in a primitive value")
+    return document
+
+
+def _add(document, tokens: list, value):
+    if not tokens:
+        return value
+    parent = _resolve(document, tokens[:-1])
+    last = tokens[-1]
+    if isinstance(parent, dict):
+        parent[last] = value
+    elif isinstance(parent, list):
+        index = _array_index(last, parent, allow_end=True)
+        if index > len(parent):
+            raise JsonPatchError(f"Array index {index} is out of range")
+        parent.insert(index, value)
+    else:
+        raise JsonPatchError("Can not add a value to a primitive value")
+    return document
+
+
+def _remove(document, tokens: list):
+    if not tokens:
+        raise JsonPatchError("Can not remove the root of a document")
+    parent = _resolve(document, tokens[:-1])
+    last = tokens[-1]
+    if isinstance(parent, dict):
+        if last not in parent:
+            raise JsonPatchError(f"Key '{last}' not found")
+        return parent.pop(last)
+    if isinstance(parent, list):
+        index = _array_index(last, parent)
+        if index >= len(parent):
+            raise JsonPatchError(f"Array index {index} is out of range")
+        return parent.pop(index)
+    raise JsonPatchError("Can not remove a value from a primitive value")
+
+
+def _copy(value):
+    if isinstance(value, dict):
+        return {key: _copy(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    return value
+
+
+def _get_member(operation: dict, name: str, string: bool = False):
+    if name not in operation:
+        raise JsonPatchError(f"Operation '{operation.get('op')}' must have member '{name}'")
+    value = operation[name]
+    if string and not isinstance(value, str):
+        raise JsonPatchError(f"Member '{name}' of operation must be a string")
+    return value
+
+
+def patch(document, operations: list):
+    """
+    Applies a JSON patch to a document.
+
+    Args:
+        document: The parsed JSON document to patch, it is not modified.
+        operations: A list of RFC 6902 operations.
+
+    Returns:
+        The patched document.
+
+    Raises:
+        JsonPatchError: If the patch is malformed or does not apply.
+    """
+    if not isinstance(operations, list):
+        raise JsonPatchError("JSON patch must be an array of objects")
+
+    result = _copy(document)
+    for operation in operations:
+        if not isinstance(operation, dict):
+            raise JsonPatchError("JSON patch must be an array of objects")
+
+        op = _get_member(operation, "op", string=True)
+        tokens = _split_pointer(_get_member(operation, "path", string=True))
+
+        if op == "add":
+            result = _add(result, tokens, _copy(_get_member(operation, "value")))
+        elif op == "remove":
+            _remove(result, tokens)
+        elif op == "replace":
+            value = _copy(_get_member(operation, "value"))
+            if not tokens:
+                result = value
+            else:
+                parent = _resolve(result, tokens[:-1])
+                if isinstance(parent, list):
+                    index = _array_index(tokens[-1], parent)
+                    if index >= len(parent):
+                        raise JsonPatchError(f"Array index {index} is out of range")
+                    parent[index] = value
+                else:
+                    _resolve(parent, tokens[-1:])
+                    parent[tokens[-1]] = value
+        elif op == "move":
+            source = _split_pointer(_get_member(operation, "from", string=True))
+            value = _resolve(result, source)
+            _remove(result, source)
+            result = _add(result, tokens, value)
+        elif op == "copy":
+            source = _split_pointer(_get_member(operation, "from", string=True))
+            result = _add(result, tokens, _copy(_resolve(result, source)))
+        elif op == "test":
+            try:
+                success = _equal(_resolve(result, tokens), _get_member(operation, "value"))
+            except JsonPatchError:
+                success = False
+            if not success:
+                raise JsonPatchError(f"Unsuccessful: {operation}")
+        else:
+            raise JsonPatchError(f"Operation value '{op}' is invalid")
+
+    return result
+
+
+class _JsonWorker:
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._process = None
+        self._lock = asyncio.Lock()
+
+    async def _start(self) -> None:
+        self._process = await asyncio.create_subprocess_exec(
+            self._path,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            limit=_LINE_LIMIT
+        )
+
+    async def _write(self, jobs: list) -> None:
+        for mode, json1, json2 in jobs:
+            self._process.stdin.write(
+                f"{mode}\n{json.dumps(json1)}\n{json.dumps(json2)}\n".encode())
+            await self._process.stdin.drain()
+
+    async def run(self, jobs: list) -> list:
+        async with self._lock:
+            if self._process is None or self._process.returncode is not None:
+                await self._start()
+
+            # write and read at the same time, otherwise both pipes can fill up
+            writer = asyncio.create_task(self._write(jobs))
+            results = []
+            try:
+                for _ in jobs:
+                    line = await self._process.stdout.readline()
+                    if not line:
+                        raise JsonWorkerError(f"{self._path} stopped unexpectedly")
+                    line = line.rstrip(b"\n")
+                    results.append(json.loads(line) if line else None)
+                await writer
+            except BaseException:
+                writer.cancel()
+                await self.close()
+                raise
+            return results
+
+    async def close(self) -> None:
+        if self._process is None:
+            return
+        process, self._process = self._process, None
+        if process.returncode is None:
+            process.stdin.close()
+            try:
+                await asyncio.wait_for(process.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+
+
+class JsonWorkerPool:
+    """
+    A pool of long running ./json/json processes. Each worker reads newline
+    delimited diff/patch jobs from one pipe, a batch is split over the workers
+    and the results are returned in the order of the jobs.
+    """
+
+    def __init__(self, size: int, path: str = JSON_BINARY) -> None:
+        self._workers = [_JsonWorker(path) for _ in range(max(size, 1))]
+
+    async def __aenter__(self) -> "JsonWorkerPool":
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self.close()
+
+    async def run(self, mode: str, pairs: list) -> list:
+        """
+        Runs a batch of jobs of a single mode ('diff' or 'patch').
+        A job that fails results in None.
+        """
+        jobs = [(mode, json1, json2) for json1, json2 in pairs]
+        if not jobs:
+            return []
+        chunk = -(-len(jobs) // len(self._workers))
+        parts = await asyncio.gather(*(
+            worker.run(jobs[i * chunk:(i + 1) * chunk])
+            for i, worker in enumerate(self._workers)
+            if jobs[i * chunk:(i + 1) * chunk]
+        ))
+        return [result for part in parts for result in part]
+
+    async def close(self) -> None:
+        await asyncio.gather(*(worker.close() for worker in self._workers))
+
+
+_worker_pool: JsonWorkerPool | None = None
+
+
+def set_worker_pool(pool: JsonWorkerPool | None) -> None:
+    """
+    Makes diff_many and patch_many use a pool of ./json/json workers,
+    or the in-process engine again if pool is None.
+    """
+    global _worker_pool
+    _worker_pool = pool
+
+
+def try_patch(document, operations):
+    """
+    Applies a JSON patch like patch, but reports a patch that does not apply
+    instead of raising.
+
+    Returns:
+        The patched document, or None if the patch does not apply.
+    """
+    try:
+        return patch(document, operations)
+    except JsonPatchError as e:
+        print(f"Error: {e}")
+        return None
+
+
+async def diff_many(pairs: list) -> list:
+    """
+    Diffs a batch of (source, target) pairs.
+
+    Returns:
+        The diffs in the order of the pairs. With a pool of ./json/json
+        workers a job that fails results in None, which is not the same as
+        the empty diff of equal documents.
+    """
+    if _worker_pool is not None:
+        return await _worker_pool.run("diff", pairs)
+    return [diff(source, target) for source, target in pairs]
+
+
+async def patch_many(pairs: list) -> list:
+    """
+    Patches a batch of (document, operations) pairs.
+
+    Returns:
+        The patched documents in the order of the pairs, None for every
+        patch that does not apply.
+    """
+    if _worker_pool is not None:
+        return await _worker_pool.run("patch", pairs)
+    return [try_patch(document, operations) for document, operations in pairs]
@@ -1,5 +1,5 @@
-from fastapi import FastAPI, Request, HTTPException, Depends
-from fastapi.responses import JSONResponse, RedirectResponse, FileResponse
+from fastapi import FastAPI, Request, HTTPException, Depends, Query
+from fastapi.responses import JSONResponse, RedirectResponse, FileResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import HTTPBearer
@@ -66,19 +66,33 @@ app.mount(
 # Create a pool of connections to the database
 pool = None
 
+# The canvas connection shared by all requests
+canvas_connection = None
+
 
 async def startup_event():
-    global pool
+    global pool, canvas_connection
     pool = await create_pool()  # Create the pool when the application starts
+    canvas_connection = canvasconn.ManualCanvasConnection.make_from_environment()
 
 app.add_event_handler("startup", startup_event)
 
 
 async def shutdown_event():
     await pool.close()  # Close the pool when the application shuts down
+    await canvas_connection.aclose()
 
 app.add_event_handler("shutdown", shutdown_event)
 
+
+async def get_db():
+    '''Gives a request a single connection of the pool, returned to it once the request is handled.'''
+    db = RequestConnection(pool)
+    try:
+        yield db
+    finally:
+        await db.close()
+
 ItemTypeNumberToString = {
     4: "Assignments",
     2: "Pages",
@@ -126,6 +140,9 @@ class ChangeCreate(BaseModel):
     item_type: str
     older_diff: int
     diff: str
+    content_hash: str | None = None
+    chain_length: int = 0
+    chain_bytes: int = 0
 
 
 class Change(BaseModel):
@@ -170,109 +187,128 @@ def get_current_user(request: Request):
 # https://github.com/FedorMusil/canvasarchiver/wiki/API
 
 
-def fix_json_formatting(json_data):
-    id = 0
-    old_diff = None
-    
-    formatted_data = []
-    for nested_list in json_data:
-        if not nested_list:
-            continue
-
-        first_obj = nested_list[0]
-        first_obj['id'] = id
-        first_obj['content'] = [first_obj['content']]
-        if old_diff is not None:
-            first_obj['older_diff'] = old_diff
-
-        for obj in nested_list[1:]:
-            first_obj['content'].append(obj['content'])
-
-        formatted_data.append(first_obj)
-        
-        id += 1
-        old_diff = first_obj['id']
-
-    formatted_json = json.dumps(formatted_data, indent=4)
-    return formatted_json
-
-
-
 # Get Routes
 @app.get("/change/{material_id}", dependencies=[Depends(get_current_user)])
 async def return_change_materialid(
         material_id: int,
-        user: dict = Depends(get_current_user)):
-    '''Get a change of a course by the type of material.'''
-
-    changes = await get_history(pool, user['course_id'], ItemTypeNumberToString[material_id])
-    json_formatterd = fix_json_formatting(json.loads(changes))
-
-    return json.loads(json_formatterd)
+        user: dict = Depends(get_current_user),
+        db: RequestConnection = Depends(get_db)):
+    '''Get the history of a type of material, streamed as a JSON array with a document per point in time.'''
+    chunks = await get_history_chunks(db, user['course_id'], ItemTypeNumberToString[material_id])
+    return StreamingResponse(chunks, media_type="application/json")
+
+
+@app.get("/change/{material_id}/items", dependencies=[Depends(get_current_user)])
+async def return_item_histories(material_id: int, user: dict = Depends(get_current_user)):
+    '''Get the versions of every item of a type of material, streamed as NDJSON one item at a time.'''
+    if material_id not in ItemTypeNumberToString:
+        raise HTTPException(status_code=400, detail="Invalid material id")
+    # the stream outlives the request connection of get_db, so it takes its own connection of the pool
+    return StreamingResponse(
+        stream_item_histories(pool, user['course_id'], ItemTypeNumberToString[material_id]),
+        media_type="application/x-ndjson")
+
+
+@app.get("/snapshot", dependencies=[Depends(get_current_user)])
+async def return_course_snapshot(
+        timestamp: datetime,
+        material_id: Optional[int] = None,
+        user: dict = Depends(get_current_user),
+        db: RequestConnection = Depends(get_db)):
+    '''Get the state of every item of a course at a point in time, optionally of one type of material.'''
+    if material_id is not None and material_id not in ItemTypeNumberToString:
+        raise HTTPException(status_code=400, detail="Invalid material id")
+    item_type = ItemTypeNumberToString[material_id] if material_id is not None else None
+    return await get_course_snapshot(db, user['course_id'], timestamp, item_type)
 
 
 @app.get("/changes/recent", dependencies=[Depends(get_current_user)])
-async def return_changes_recent(user: dict = Depends(get_current_user)):
+async def return_changes_recent(user: dict = Depends(get_current_user), db: RequestConnection = Depends(get_db)):
     '''Get the recent changes of a course (last 10 changes))'''
-    return await get_changes_recent(pool, user['course_id'])
+    return await get_changes_recent(db, user['course_id'])
+
+
+@app.get("/changes/feed", dependencies=[Depends(get_current_user)])
+async def return_change_feed(
+        cursor: Optional[str] = None,
+        limit: int = Query(50, ge=1, le=500),
+        material_id: Optional[int] = None,
+        item_id: Optional[int] = None,
+        change_type: Optional[str] = None,
+        include_diff: bool = False,
+        user: dict = Depends(get_current_user),
+        db: RequestConnection = Depends(get_db)):
+    '''Get a page of the changes of a course, newest first. Pass the next_cursor of a page to get the next one.'''
+    if material_id is not None and material_id not in ItemTypeNumberToString:
+        raise HTTPException(status_code=400, detail="Invalid material id")
+    if change_type is not None and change_type not in ("Addition", "Modification", "Deletion"):
+        raise HTTPException(status_code=400, detail="Invalid change type")
+    item_type = ItemTypeNumberToString[material_id] if material_id is not None else None
+    try:
+        return await get_change_feed(
+            db, user['course_id'], limit, cursor, item_type, item_id, change_type, include_diff)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 # @app.get("/change/{item_type}", dependencies=[Depends(get_current_user)])
 # async def return_change_by_id(item_type: int, user: dict = Depends(get_current_user)):
 #     '''Get a change by its change id'''
-# return await get_change_by_id(pool, user['course_id'],
+# return await get_change_by_id(db, user['course_id'],
 # ItemTypeNumberToString[item_type])
 
 
 @app.get("/self", dependencies=[Depends(get_current_user)])
-async def return_user_info(user: dict = Depends(get_current_user)):
+async def return_user_info(user: dict = Depends(get_current_user), db: RequestConnection = Depends(get_db)):
     '''Get your own information.'''
-    data = await get_user_by_id(pool, user['user_id'], user['course_id'])
+    data = await get_user_by_id(db, user['user_id'], user['course_id'])
     print(data)
 
     return data
 
 
 @app.get("/self/courses", dependencies=[Depends(get_current_user)])
-async def return_self_courses(user: dict = Depends(get_current_user)):
+async def return_self_courses(user: dict = Depends(get_current_user), db: RequestConnection = Depends(get_db)):
     '''Get all courses of the user.'''
-    return await get_courses_by_user(pool, user['user_id'])
+    return await get_courses_by_user(db, user['user_id'])
 
 
 @app.get("/annotations/{annotation_id}",
          dependencies=[Depends(get_current_user)])
 async def return_annotation_by_id(
         annotation_id: int,
-        user: dict = Depends(get_current_user)):
+        user: dict = Depends(get_current_user),
+        db: RequestConnection = Depends(get_db)):
     '''Get annotation by id'''
-    return await get_annotation_by_id(pool, user['course_id'], annotation_id)
+    return await get_annotation_by_id(db, user['course_id'], annotation_id)
 
 
 @app.get("/course/getinfo", dependencies=[Depends(get_current_user)])
-async def get_course_info_route(user: dict = Depends(get_current_user)):
+async def get_course_info_route(user: dict = Depends(get_current_user), db: RequestConnection = Depends(get_db)):
     '''Get a course by id.'''
-    return await get_course_by_id(pool, user['course_id'])
+    return await get_course_by_id(db, user['course_id'])
 
 
 @app.get("/course/users", dependencies=[Depends(get_current_user)])
-async def get_course_users_route(user: dict = Depends(get_current_user)):
+async def get_course_users_route(user: dict = Depends(get_current_user), db: RequestConnection = Depends(get_db)):
     '''Get all users in a course.'''
-    return await get_users_by_courseid(pool, user['course_id'])
+    return await get_users_by_courseid(db, user['course_id'])
 
 
 @app.get("/course/annotations/{change_id}",
          dependencies=[Depends(get_current_user)])
 async def get_annotation(
         change_id: int,
-        user: dict = Depends(get_current_user)):
+        user: dict = Depends(get_current_user),
+        db: RequestConnection = Depends(get_db)):
     '''Get all annotations for a change.'''
-    return await get_annotations_by_changeid(pool, user['course_id'], change_id)
+    return await get_annotations_by_changeid(db, user['course_id'], change_id)
 
 
 @app.get("/course/changes", dependencies=[Depends(get_current_user)])
-async def get_changes(course_id: int, user: dict = Depends(get_current_user)):
+async def get_changes(course_id: int, user: dict = Depends(get_current_user), db: RequestConnection = Depends(get_db)):
     '''Get all changes for a course.'''
-    return await get_changes_by_courseid(pool, user['course_id'])
+    return await get_changes_by_courseid(db, user['course_id'])
 
 
 # # Post Routes
@@ -283,11 +319,11 @@ async def get_changes(course_id: int, user: dict = Depends(get_current_user)):
 
 
 @app.post("/course/create")
-async def post_course_route(course: CourseCreate):
-    passed_test, error_message = await check_course_create(pool, course)
+async def post_course_route(course: CourseCreate, db: RequestConnection = Depends(get_db)):
+    passed_test, error_message = await check_course_create(db, course)
     if passed_test != 200:
         raise HTTPException(status_code=400, detail=error_message)
-    success, return_message = await post_course(pool, course)
+    success, return_message = await post_course(db, course)
     if success:
         return {"course_id": return_message}
     raise HTTPException(status_code=400, detail=return_message)
@@ -296,12 +332,13 @@ async def post_course_route(course: CourseCreate):
 @app.post("/annotations", dependencies=[Depends(get_current_user)])
 async def post_annotation_route(
         annotationObject: CreateAnnotation,
-        user: dict = Depends(get_current_user)):
+        user: dict = Depends(get_current_user),
+        db: RequestConnection = Depends(get_db)):
     '''Create an annotation.'''
-    passed_test, error_message = await check_annotation_create(pool, user['course_id'], annotationObject.change_id, annotationObject.text)
+    passed_test, error_message = await check_annotation_create(db, user['course_id'], annotationObject.change_id, annotationObject.text)
     if not passed_test:
         raise HTTPException(status_code=400, detail=error_message)
-    success, return_message = await post_annotation(pool, annotationObject.change_id, annotationObject.text)
+    success, return_message = await post_annotation(db, annotationObject.change_id, annotationObject.text)
     if success:
         return {"annotation_id": return_message}
     raise HTTPException(status_code=400, detail=return_message)
@@ -311,12 +348,13 @@ async def post_annotation_route(
 @app.put("/changes", dependencies=[Depends(get_current_user)])
 async def put_change_route(
         change: ChangeCreate,
-        user: dict = Depends(get_current_user)):
+        user: dict = Depends(get_current_user),
+        db: RequestConnection = Depends(get_db)):
     '''Create a change.'''
-    passed_test, error_message = await check_change_create(pool, user["course_id"], change)
+    passed_test, error_message = await check_change_create(db, user["course_id"], change)
     if not passed_test:
         raise HTTPException(status_code=400, detail=error_message)
-    success, return_message = await post_change(pool, user["course_id"], change)
+    success, return_message = await post_change(db, user["course_id"], change)
     if success:
         return {"change_id": return_message}
     raise HTTPException(status_code=400, detail=return_message)
@@ -327,9 +365,10 @@ async def put_change_route(
 async def put_highlight_route(
         changeId: int,
         request: Puthighlight,
-        user: dict = Depends(get_current_user)):
+        user: dict = Depends(get_current_user),
+        db: RequestConnection = Depends(get_db)):
     '''edit a highlight'''
-    return await put_highlight(pool, user['course_id'], changeId)
+    return await put_highlight(db, user['course_id'], changeId, request)
 
 
 # Delete routes
@@ -337,30 +376,45 @@ async def put_highlight_route(
             dependencies=[Depends(get_current_user)])
 async def delete_annotation(
         annotation_id: int,
-        user: dict = Depends(get_current_user)):
+        user: dict = Depends(get_current_user),
+        db: RequestConnection = Depends(get_db)):
     '''Delete an annotation.'''
-    return await delete_annotation_by_id(pool, user['course_id'], annotation_id)
+    return await delete_annotation_by_id(db, user['course_id'], annotation_id)
 
 
 @app.post("/course/{course_id}/user", dependencies=[Depends(get_current_user)])
-async def post_user_route(course_id: int, user: UserCreate):
+async def post_user_route(course_id: int, user: UserCreate, db: RequestConnection = Depends(get_db)):
     '''Create a user.'''
-    passed_test, error_message = await check_user_create(pool, course_id, user)
+    passed_test, error_message = await check_user_create(db, course_id, user)
     if not passed_test:
         raise HTTPException(status_code=400, detail=error_message)
-    success, return_message = await post_user(pool, course_id, user)
+    success, return_message = await post_user(db, course_id, user)
     if success:
         return {"user_id": return_message}
     raise HTTPException(status_code=400, detail=return_message)
 
 
+def require_stats_token(request: Request):
+    '''Only lets requests through with the STATS_TOKEN of the environment as bearer token, none without one.'''
+    token = getenv('STATS_TOKEN')
+    authorization = request.headers.get('Authorization', '')
+    if not token or not hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode()):
+        raise HTTPException(status_code=403, detail="Not allowed")
+
+
+@app.get("/stats/db", dependencies=[Depends(require_stats_token)])
+async def return_db_stats():
+    '''Get the connection pool metrics: acquire wait times, connections in use and the latency of every query.'''
+    return pool.get_stats()
+
+
 @app.post("/cron",
             dependencies=[Depends(get_current_user)])
 async def run_cron_job_route(
         annotation_id: int,
         user: dict = Depends(get_current_user)):
     '''Run a cron job.'''
-    return await cron_job_by_course_id(user['course_id'])
+    return await cron_job_by_course_id(canvas_connection, pool, user['course_id'])
 
 
 
@@ -386,35 +440,34 @@ async def post_revert_changes(change: Change,
             status_code=400,
             detail="Invalid item type provided.")
 
-    async with canvasconn.ManualCanvasConnection.make_from_environment() as conn:
-        api = Canvas(conn)
+    api = Canvas(canvas_connection)
 
-        try:
-            canvas_object = canvas_object_type(api).json_init(
-                change_data).set_related(Course(api).set_id(user["course_id"]))
-            await canvas_object.resolve()
-        except ResponseError as e:
-            if e.get_response().status_code == 404:
-                try:
-                    canvas_object = await canvas_object.create(**change_data)
-                except ResponseError as create_error:
-                    raise HTTPException(
-                        status_code=create_error.get_response().status_code,
-                        detail=str(create_error))
-            else:
-                raise HTTPException(
-                    status_code=e.get_response().status_code,
-                    detail=str(e))
-
-        if canvas_object.has_id():
+    try:
+        canvas_object = canvas_object_type(api).json_init(
+            change_data).set_related(Course(api).set_id(user["course_id"]))
+        await canvas_object.resolve()
+    except ResponseError as e:
+        if e.get_response().status_code == 404:
             try:
-                await canvas_object.edit(**change_data)
-            except ResponseError as edit_error:
+                canvas_object = await canvas_object.create(**change_data)
+            except ResponseError as create_error:
                 raise HTTPException(
-                    status_code=edit_error.get_response().status_code,
-                    detail=str(edit_error))
+                    status_code=create_error.get_response().status_code,
+                    detail=str(create_error))
+        else:
+            raise HTTPException(
+                status_code=e.get_response().status_code,
+                detail=str(e))
+
+    if canvas_object.has_id():
+        try:
+            await canvas_object.edit(**change_data)
+        except ResponseError as edit_error:
+            raise HTTPException(
+                status_code=edit_error.get_response().status_code,
+                detail=str(edit_error))
 
-        return {"status": "success", "data": canvas_object.get_data()}
+    return {"status": "success", "data": canvas_object.get_data()}
 
 
 state_nonce_store = {}
@@ -496,7 +549,7 @@ async def handle_initiation_post(request: Request):
 
 
 @app.post("/redirect")
-async def handle_redirect(request: Request):
+async def handle_redirect(request: Request, db: RequestConnection = Depends(get_db)):
     clean_expired_state_nonce()
 
     data = await request.form()
@@ -565,10 +618,10 @@ async def handle_redirect(request: Request):
 
     print(email, name, role, course_code, course_name, user_id, course_id)
 
-    succes, message = await post_course(pool, course_id, course_name, course_code)
+    succes, message = await post_course(db, course_id, course_name, course_code)
     print(succes, message)
     if succes == 200 or succes == 405:
-        succes, message = await post_user(pool, message, user_id, email, name, role)
+        succes, message = await post_user(db, message, user_id, email, name, role)
         print(succes, message)
     else:
         raise HTTPException(status_code=400, detail=message)
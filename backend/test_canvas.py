@@ -0,0 +1,106 @@
+import asyncio
+import json
+
+import httpx
+
+import canvas._impl as _impl
+import canvas.canvas as canvasapi
+import canvas.connection as connection
+
+
+BASE = 'https://canvas.test/api/v1/courses/1/assignments'
+
+
+def make_api(handler, **kwargs):
+    conn = connection.ManualCanvasConnection('https://canvas.test', 'token', http2=False)
+    conn.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return canvasapi.Canvas(conn, **kwargs)
+
+
+def paginated(pages, with_last=True):
+    requested = []
+    in_flight = 0
+    max_in_flight = 0
+
+    async def handler(request):
+        nonlocal in_flight, max_in_flight
+        requested.append(request.url)
+        page = int(request.url.params.get('page', 1))
+        per_page = request.url.params['per_page']
+        links = []
+        if page < pages:
+            links.append(f'<{BASE}?page={page + 1}&per_page={per_page}>; rel="next"')
+        if with_last:
+            links.append(f'<{BASE}?page={pages}&per_page={per_page}>; rel="last"')
+
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        # later pages answer faster, the order must still be kept
+        await asyncio.sleep(0.01 * (pages - page))
+        in_flight -= 1
+        return httpx.Response(
+            200,
+            json=[{'id': page * 10 + i} for i in range(2)],
+            headers={'Link': ','.join(links)} if links else {})
+
+    return handler, requested, lambda: max_in_flight
+
+
+def list_ids(api):
+    async def run():
+        course = canvasapi.Course(api).set_id(1)
+        return [a.get_id() async for a in api.get_assignments(course)]
+
+    return asyncio.run(run())
+
+
+def test_get_list_prefetches_pages_in_order():
+    handler, requested, max_in_flight = paginated(6)
+    ids = list_ids(make_api(handler, prefetch=3))
+
+    assert ids == [page * 10 + i for page in range(1, 7) for i in range(2)]
+    assert requested[0].params['per_page'] == '100'
+    assert len(requested) == 6
+    assert max_in_flight() == 3
+
+
+def test_get_list_follows_next_without_last():
+    handler, requested, max_in_flight = paginated(3, with_last=False)
+    ids = list_ids(make_api(handler, per_page=2))
+
+    assert ids == [10, 11, 20, 21, 30, 31]
+    assert requested[0].params['per_page'] == '2'
+    assert max_in_flight() == 1
+
+
+def test_get_list_streams_pages():
+    handler, requested, max_in_flight = paginated(3)
+
+    async def chunked(request):
+        response = await handler(request)
+        body = response.content
+
+        async def chunks():
+            # split the body at awkward places, like inside strings
+            for i in range(0, len(body), 3):
+                yield body[i:i + 3]
+
+        return httpx.Response(200, content=chunks(), headers=response.headers)
+
+    ids = list_ids(make_api(chunked, stream_lists=True))
+
+    assert ids == [10, 11, 20, 21, 30, 31]
+    assert requested[0].params['per_page'] == '100'
+    assert max_in_flight() == 1
+
+
+def test_json_array_decoder_chunks():
+    document = [{'id': 1, 'body': '<p>"a", [b] {c} \\ é</p>', 'items': [1, {}]}, 2, 'x,]', None, []]
+    raw = json.dumps(document, ensure_ascii=False).encode()
+    for size in range(1, len(raw) + 1):
+        decoder = _impl.JsonArrayDecoder()
+        items = []
+        for i in range(0, len(raw), size):
+            items += decoder.feed(raw[i:i + size])
+        decoder.close()
+        assert items == document
@@ -0,0 +1,185 @@
+import asyncio
+import json
+
+import httpx
+
+import canvas.connection as connection
+
+
+def make_connection(handler, **limiter_args):
+    limiter_args.setdefault('backoff', 0)
+    conn = connection.ManualCanvasConnection(
+        'https://canvas.test', 'token', http2=False,
+        limiter=connection.AdaptiveLimiter(**limiter_args))
+    conn.client = httpx.AsyncClient(
+        transport=httpx.MockTransport(handler), headers=conn.client.headers)
+    return conn
+
+
+def test_limit_follows_remaining_bucket():
+    remaining = iter([500, 500, 50, 500])
+
+    def handler(request):
+        assert request.headers['Authorization'] == 'Bearer token'
+        return httpx.Response(200, json=[], headers={
+            'X-Rate-Limit-Remaining': str(next(remaining)),
+            'X-Request-Cost': '1.5'})
+
+    async def run():
+        async with make_connection(handler, initial=4, maximum=5) as conn:
+            limits = []
+            for _ in range(4):
+                await conn.request('GET', '/api/v1/courses')
+                limits.append(conn.get_stats()['limit'])
+            return limits, conn.get_stats()
+
+    limits, stats = asyncio.run(run())
+    assert limits == [5, 5, 2, 3]
+    assert stats['requests'] == 4
+    assert stats['cost'] == 6.0
+    assert stats['remaining'] == 500
+
+
+def test_throttled_requests_are_retried():
+    responses = iter([
+        httpx.Response(403, text='403 Forbidden (Rate Limit Exceeded)'),
+        httpx.Response(403, text='403 Forbidden (Rate Limit Exceeded)'),
+        httpx.Response(200, json={'id': 1}),
+    ])
+
+    async def run():
+        async with make_connection(lambda request: next(responses), initial=8) as conn:
+            response = await conn.request('GET', '/api/v1/courses/1')
+            return response, conn.get_stats()
+
+    response, stats = asyncio.run(run())
+    assert response.status_code == 200
+    assert stats['throttled'] == 2
+    assert stats['retries'] == 2
+    assert stats['limit'] == 2
+
+
+def test_in_flight_requests_are_bounded():
+    in_flight = 0
+    max_in_flight = 0
+
+    async def handler(request):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return httpx.Response(200, json=[])
+
+    async def run():
+        async with make_connection(handler, initial=3, maximum=3) as conn:
+            await asyncio.gather(*(conn.request('GET', '/api/v1/courses') for _ in range(12)))
+
+    asyncio.run(run())
+    assert max_in_flight == 3
+
+
+def test_conditional_requests_use_committed_validators(tmp_path):
+    conditional = []
+
+    def handler(request):
+        conditional.append(request.headers.get('If-None-Match'))
+        if request.headers.get('If-None-Match') == '"v1"':
+            return httpx.Response(304, headers={'Link': '<https://canvas.test/next>; rel="next"'})
+        return httpx.Response(200, json=[{'id': 1}], headers={
+            'ETag': '"v1"', 'Link': '<https://canvas.test/next>; rel="next"'})
+
+    async def run():
+        conn = make_connection(handler)
+        conn.validators = connection.ValidatorCache(str(tmp_path / 'validators.db'))
+        async with conn:
+            first = await conn.request('GET', '/api/v1/courses/1/pages')
+            # not committed yet, a failed sync downloads everything again
+            conn.validators.close()
+            conn.validators = connection.ValidatorCache(str(tmp_path / 'validators.db'))
+            await conn.request('GET', '/api/v1/courses/1/pages')
+            conn.commit_validators('/api/v1/courses/1')
+            second = await conn.request('GET', '/api/v1/courses/1/pages')
+            async with conn.stream('GET', '/api/v1/courses/1/pages') as streamed:
+                third = await streamed.aread()
+            return first, second, third, conn.get_stats()
+
+    first, second, third, stats = asyncio.run(run())
+    assert conditional == [None, None, '"v1"', '"v1"']
+    assert not first.extensions.get('unchanged')
+    assert second.extensions['unchanged']
+    assert second.json() == first.json()
+    assert third == first.content
+    assert second.headers['Link'] == first.headers['Link']
+    assert stats['not_modified'] == 2
+
+
+def test_not_modified_pages_use_current_links(tmp_path):
+    requests = []
+    links = {'/api/v1/a': '<https://canvas.test/a?page=2>; rel="next"', '/api/v1/b': None}
+
+    def handler(request):
+        conditional = request.headers.get('If-None-Match') is not None
+        requests.append((request.url.path, conditional))
+        if conditional:
+            # the page is the same, but a page was added behind it
+            return httpx.Response(304)
+        headers = {'ETag': '"v1"'}
+        if links[request.url.path] is not None:
+            headers['Link'] = links[request.url.path]
+        return httpx.Response(200, json=[{'id': 1}], headers=headers)
+
+    async def run():
+        conn = make_connection(handler)
+        conn.validators = connection.ValidatorCache(str(tmp_path / 'validators.db'))
+        async with conn:
+            for url in links:
+                await conn.request('GET', url)
+            conn.commit_validators('/api/v1')
+            links['/api/v1/a'] = '<https://canvas.test/a?page=2>; rel="next", <https://canvas.test/a?page=3>; rel="last"'
+            paged = await conn.request('GET', '/api/v1/a')
+            async with conn.stream('GET', '/api/v1/b') as single:
+                await single.aread()
+            return paged, single, conn.get_stats()
+
+    paged, single, stats = asyncio.run(run())
+    # without the links of canvas the page of a list is downloaded again, a single object is not
+    assert requests[2:] == [('/api/v1/a', True), ('/api/v1/a', False), ('/api/v1/b', True)]
+    assert paged.headers['Link'] == links['/api/v1/a']
+    assert not paged.extensions.get('unchanged')
+    assert single.extensions['unchanged']
+    assert stats['not_modified'] == 1
+
+
+def test_validator_cache_only_when_asked(tmp_path, monkeypatch):
+    monkeypatch.setenv('CANVAS_VALIDATOR_CACHE', str(tmp_path / 'validators.db'))
+    # the web process never commits, its staged validators would only pile up
+    shared = connection.ManualCanvasConnection.make_from_environment()
+    cron = connection.ManualCanvasConnection.make_from_environment(validators=True)
+    try:
+        assert shared.validators is None
+        assert cron.validators is not None
+    finally:
+        asyncio.run(shared.aclose())
+        asyncio.run(cron.aclose())
+
+
+def test_streamed_responses_are_not_stored(tmp_path):
+    def handler(request):
+        return httpx.Response(200, json=[{'id': 1}], headers={'ETag': '"v1"'})
+
+    async def run():
+        conn = make_connection(handler)
+        conn.validators = connection.ValidatorCache(str(tmp_path / 'validators.db'))
+        async with conn:
+            async with conn.stream('GET', '/api/v1/courses/1/pages') as streamed:
+                body = await streamed.aread()
+            # storing the body needs all of it, that would defeat streaming
+            staged = dict(conn.validators._staged)
+            await conn.request('GET', '/api/v1/courses/1/pages')
+            return body, staged, dict(conn.validators._staged)
+
+    body, streamed, requested = asyncio.run(run())
+    assert json.loads(body) == [{'id': 1}]
+    assert streamed == {}
+    assert list(requested) == ['/api/v1/courses/1/pages']
@@ -43,6 +43,9 @@ class Item:
     def get_data(self):
         return self.data
 
+    def is_unchanged(self):
+        return False
+
 
 class TestDiffDetection(asynctest.TestCase):
     async def setUp(self):
@@ -93,29 +96,34 @@ class TestDiffDetection(asynctest.TestCase):
         changes = await fapi.get_changes_by_courseid(self.pool, course_id)
         self.assertEqual(len(changes), 1)
 
-        original_version = json.loads(changes[0]['diff'])
+        original_version = fapi.load_diff(changes[0]['diff'])
 
-        await cron_job.process_item_diff(self.pool, item, 'Courses', course_id, changes, timestamp)
+        # the storage columns the sync needs are only read by get_latest_changes_by_courseid
+        index = cron_job.index_changes(await fapi.get_latest_changes_by_courseid(self.pool, course_id))
+        await cron_job.process_item_diff(self.pool, item, 'Courses', course_id, index, timestamp)
 
         changes = await fapi.get_changes_by_courseid(self.pool, course_id)
         self.assertEqual(len(changes), 2)
 
         most_recent = cron_job.get_most_recent_change(
-            changes, 'Courses', course_id)
+            cron_job.index_changes(changes), 'Courses', course_id)
+        self.assertEqual(
+            cron_job.get_most_recent_change(index, 'Courses', course_id)['id'],
+            most_recent['id'])
 
         self.assertEqual(most_recent['change_type'], 'Modification')
         self.assertEqual(
-            json.loads(most_recent['diff'])['name'],
+            fapi.load_diff(most_recent['diff'])['name'],
             'Random Course 2'
         )
 
         older_diff = await fapi.get_change_by_id(self.pool, most_recent['older_diff'])
-        diff = json.loads(older_diff['diff'])
+        diff = fapi.load_diff(older_diff['diff'])
         self.assertEqual(
             json.loads('[{"op": "replace", "path": "/name", "value": "Random Course"}]'),
             diff)
 
-        result = get_patched(json.loads(most_recent['diff']), diff)
+        result = get_patched(fapi.load_diff(most_recent['diff']), diff)
         self.assertEqual(result, original_version)
 
         await fapi.remove_change_by_id(self.pool, most_recent['id'])
@@ -0,0 +1,149 @@
+import asyncio
+import json
+from datetime import datetime
+
+# cron_job and program import each other, program has to be imported first
+import program  # noqa: F401
+import cron_job
+
+
+class FakeWriter(cron_job.ChangeWriter):
+    def __init__(self):
+        super().__init__(None, 1)
+        self.last_id = 100
+
+    async def _next_id(self):
+        self.last_id += 1
+        return self.last_id
+
+
+class Page:
+    def __init__(self, data, unchanged=False):
+        self.data = data
+        self.unchanged = unchanged
+
+    def get_data(self):
+        return self.data
+
+    def is_unchanged(self):
+        return self.unchanged
+
+
+def stored(change_id, data, content_hash):
+    return {
+        'id': change_id, 'item_id': data['page_id'], 'item_type': 'Pages', 'change_type': 'Addition',
+        'timestamp': datetime.now(), 'older_diff': None, 'diff': json.dumps(data), 'content_hash': content_hash,
+        'chain_length': 0, 'chain_bytes': 0
+    }
+
+
+def process(writer, pages, index):
+    asyncio.run(cron_job.process_item_diffs(writer, pages, 'Pages', 1, index, datetime.now()))
+
+
+def test_unchanged_items_are_not_diffed():
+    same = {'page_id': 1, 'url': 'same', 'body': 'a'}
+    unhashed = {'page_id': 2, 'url': 'unhashed', 'body': 'b'}
+    changed = {'page_id': 3, 'url': 'changed', 'body': 'c'}
+    not_modified = {'page_id': 4, 'url': 'not-modified', 'body': 'd'}
+    index = cron_job.index_changes([
+        stored(1, same, cron_job.jsondiff.content_hash(same)),
+        stored(2, unhashed, None),
+        stored(3, dict(changed, body='old'), 'outdated'),
+        stored(4, dict(not_modified, body='old'), None),
+    ])
+
+    writer = FakeWriter()
+    # canvas answered 304 Not Modified for the last page
+    process(writer, [Page(same), Page(unhashed), Page(changed), Page(not_modified, unchanged=True)], index)
+
+    assert (writer.diffs, writer.skipped_diffs) == (2, 2)
+    # the version stored without a hash gets one, the changed item a new version
+    assert writer._content_hashes == [(cron_job.jsondiff.content_hash(unhashed), 2)]
+    assert writer._removed_ids == [3]
+    # annotations of the replaced version move to the reverse diff that stores it now
+    assert writer._replaced == [(3, 101)]
+    assert cron_job.get_most_recent_change(index, 'Pages', 3)['content_hash'] == cron_job.jsondiff.content_hash(changed)
+
+
+def test_failed_diff_leaves_version_alone(monkeypatch):
+    old = {'page_id': 1, 'url': 'page', 'body': 'old'}
+    index = cron_job.index_changes([stored(1, old, None)])
+
+    async def failed_diffs(pairs):
+        # a ./json/json worker gives None for a job that failed
+        return [None for _ in pairs]
+
+    monkeypatch.setattr(cron_job.jsondiff, 'diff_many', failed_diffs)
+    writer = FakeWriter()
+    process(writer, [Page(dict(old, body='new'))], index)
+
+    assert (writer._changes, writer._removed_ids, writer._content_hashes) == ({}, [], [])
+
+
+def test_keyframe_after_interval(monkeypatch):
+    old = {'page_id': 1, 'url': 'page', 'body': 'old'}
+    new = dict(old, body='new')
+    latest = dict(stored(1, old, cron_job.jsondiff.content_hash(old)), chain_length=2, chain_bytes=100)
+    index = cron_job.index_changes([latest])
+
+    monkeypatch.setattr(cron_job, 'KEYFRAME_INTERVAL', 3)
+    writer = FakeWriter()
+    process(writer, [Page(new)], index)
+
+    # the replaced version is kept in full and the chain starts over
+    keyframe, newest = writer._changes.values()
+    assert (json.loads(keyframe[7]), keyframe[8]) == (old, latest['content_hash'])
+    assert newest[9:] == (0, 0)
+
+
+def test_reverse_diff_before_interval():
+    old = {'page_id': 1, 'url': 'page', 'body': 'old'}
+    latest = dict(stored(1, old, cron_job.jsondiff.content_hash(old)), chain_length=2, chain_bytes=100)
+    index = cron_job.index_changes([latest])
+
+    writer = FakeWriter()
+    process(writer, [Page(dict(old, body='new'))], index)
+
+    reverse, newest = writer._changes.values()
+    assert json.loads(reverse[7]) == [{'op': 'replace', 'path': '/body', 'value': 'old'}]
+    assert reverse[8] is None
+    assert newest[6] == reverse[0]
+    assert newest[9:] == (3, 100 + len(reverse[7]))
+
+
+class Course:
+    def __init__(self, course_id):
+        self.course_id = course_id
+
+    def get_id(self):
+        return self.course_id
+
+
+def test_sync_courses_bounded_concurrency_and_isolated_failures(monkeypatch):
+    running = 0
+    max_running = 0
+
+    async def fake_cron_job(api, pool, course, stats=None):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        try:
+            if course.get_id() == 2:
+                raise Exception('sync failed')
+            if course.get_id() == 3:
+                await asyncio.sleep(10)
+            await asyncio.sleep(0.01)
+            return course.get_id() * 10
+        finally:
+            running -= 1
+
+    monkeypatch.setattr(cron_job, 'cron_job', fake_cron_job)
+    courses = [Course(i) for i in range(1, 7)]
+    results = asyncio.run(cron_job.sync_courses(None, None, courses, concurrency=2, timeout=0.5))
+
+    assert max_running == 2
+    assert [result['course'] for result in results] == list(range(1, 7))
+    assert 'sync failed' in results[1]['error']
+    assert results[2]['error'] is not None
+    assert [result['items'] for result in results] == [10, 0, 0, 40, 50, 60]
@@ -0,0 +1,394 @@
+import asyncio
+import json
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import controllers.frontend_api as fapi
+
+
+T1 = datetime(2024, 1, 1)
+T2 = datetime(2024, 1, 2)
+T3 = datetime(2024, 1, 3)
+
+
+def change(change_id, item_id, timestamp, change_type, older_diff, diff):
+    return {
+        'id': change_id,
+        'item_id': item_id,
+        'course_id': 1,
+        'change_type': change_type,
+        'timestamp': timestamp,
+        'item_type': 'Pages',
+        'older_diff': older_diff,
+        'diff': json.dumps(diff),
+        'highlights': None
+    }
+
+
+def test_build_history():
+    changes = [
+        # item 1: added at T1, modified at T3
+        change(1, 1, T1, 'Addition', None, [{'op': 'replace', 'path': '/title', 'value': 'old'}]),
+        change(4, 1, T3, 'Modification', 1, {'title': 'new'}),
+        # item 2: added at T2, never modified
+        change(2, 2, T2, 'Addition', None, {'title': 'second'}),
+    ]
+
+    history = fapi.build_history(changes)
+
+    assert [[entry['timestamp'] for entry in step] for step in history] == [
+        [T1.isoformat()],
+        [T2.isoformat(), T2.isoformat()],
+        [T3.isoformat(), T3.isoformat()],
+    ]
+    assert [[entry['content'] for entry in step] for step in history] == [
+        [{'title': 'old'}],
+        [{'title': 'new'}, {'title': 'second'}],
+        [{'title': 'new'}, {'title': 'second'}],
+    ]
+    assert all('diff' not in entry for step in history for entry in step)
+
+
+def test_build_history_without_changes():
+    assert fapi.build_history([]) == []
+
+
+class FakeConnection:
+    def __init__(self, changes, queries):
+        self.changes = changes
+        self.queries = queries
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        pass
+
+    async def fetchrow(self, query, *args):
+        self.queries.append(query)
+        if 'FROM courses' in query:
+            return {'id': 7}
+        return (max(change['id'] for change in self.changes), len(self.changes))
+
+    async def fetch(self, query, *args):
+        self.queries.append(query)
+        return list(self.changes)
+
+
+class FakePool:
+    def __init__(self, changes):
+        self.changes = changes
+        self.queries = []
+
+    def acquire(self):
+        return FakeConnection(self.changes, self.queries)
+
+
+def test_history_cache():
+    fapi.history_cache.clear()
+    pool = FakePool([change(1, 1, T1, 'Addition', None, {'title': 'first'})])
+
+    first = asyncio.run(fapi.get_history(pool, 1234, 'Pages'))
+    second = asyncio.run(fapi.get_history(pool, 1234, 'Pages'))
+    assert first == second
+    assert sum(query.startswith('SELECT * FROM change_records') for query in pool.queries) == 1
+
+    pool.changes.append(change(2, 2, T2, 'Addition', None, {'title': 'second'}))
+    third = asyncio.run(fapi.get_history(pool, 1234, 'Pages'))
+    assert third != first
+    assert sum(query.startswith('SELECT * FROM change_records') for query in pool.queries) == 2
+
+    fapi.invalidate_history_cache(7)
+    assert not fapi.history_cache
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.statements = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        pass
+
+    def acquire(self):
+        return self
+
+    def transaction(self):
+        return self
+
+    async def execute(self, query, *args):
+        self.statements.append((' '.join(query.split()), args))
+
+    async def executemany(self, query, args):
+        self.statements.append((' '.join(query.split()), list(args)))
+
+
+def test_write_changes_stores_snapshots_once():
+    conn = RecordingConnection()
+    changes = [
+        (1, 7, T1, 1, 'Addition', 'Pages', None, '{"title": "a"}', 'hash-a'),
+        (2, 7, T1, 2, 'Addition', 'Pages', None, '{"title": "a"}', 'hash-a'),
+        (3, 7, T1, 3, 'Addition', 'Pages', 1, '[]', None),
+    ]
+    assert asyncio.run(fapi.write_changes(conn, changes, [])) == (True, 3)
+
+    lock, (snapshots, body), (inserts, rows) = conn.statements
+    assert lock == ('SELECT pg_advisory_xact_lock_shared($1)', (fapi.SNAPSHOTS_LOCK,))
+    assert snapshots.startswith('INSERT INTO snapshots')
+    assert body == [('hash-a', '{"title": "a"}'), ('hash-a', '{"title": "a"}')]
+    assert inserts.startswith('INSERT INTO changes')
+    # full versions are only stored in the snapshots, diffs stay in the changes
+    assert [(row[7], row[8]) for row in rows] == [(None, 'hash-a'), (None, 'hash-a'), ('[]', None)]
+
+
+def test_write_changes_keeps_annotations_of_replaced_changes():
+    conn = RecordingConnection()
+    # change 5, the newest version of its item with an annotation, is stored again as reverse diff 8
+    changes = [
+        (8, 7, T1, 1, 'Addition', 'Pages', None, '[]', None, 1, 2),
+        (9, 7, T2, 1, 'Modification', 'Pages', 8, '{"title": "b"}', None, 1, 2),
+    ]
+    assert asyncio.run(fapi.write_changes(conn, changes, [5], replaced=[(5, 8)])) == (True, 2)
+
+    statements = [statement.split()[:2] for statement, _ in conn.statements]
+    # the annotations point to the new change before the annotated one is deleted
+    assert statements == [['SELECT', 'pg_advisory_xact_lock_shared($1)'], ['INSERT', 'INTO'], ['UPDATE', 'annotations'],
+                          ['UPDATE', 'changes'], ['DELETE', 'FROM']]
+    assert conn.statements[2][1] == [(5, 8)]
+    assert conn.statements[3][1] == [(5, 8)]
+    assert conn.statements[4][1] == ([5],)
+
+
+class PruneConnection(RecordingConnection):
+    async def execute(self, query, *args):
+        await super().execute(query, *args)
+        return 'DELETE 2'
+
+
+def test_prune_snapshots_waits_for_writers():
+    conn = PruneConnection()
+    assert asyncio.run(fapi.prune_snapshots(conn)) == (True, 2)
+    # the writers hold the same lock shared until their changes are committed
+    (lock, args), (delete, _) = conn.statements
+    assert (lock, args) == ('SELECT pg_advisory_xact_lock($1)', (fapi.SNAPSHOTS_LOCK,))
+    assert delete.startswith('DELETE FROM snapshots')
+
+
+def test_build_history_from_jsonb():
+    # the connection pool decodes JSONB columns, TEXT columns are parsed by build_history
+    changes = [
+        change(1, 1, T1, 'Addition', None, [{'op': 'replace', 'path': '/title', 'value': 'old'}]),
+        change(2, 1, T2, 'Modification', 1, {'title': 'new'}),
+    ]
+    decoded = [dict(row, diff=json.loads(row['diff'])) for row in changes]
+    assert fapi.build_history(decoded) == fapi.build_history(changes)
+    assert fapi.dump_diff(decoded[1]['diff']) == changes[1]['diff']
+
+
+def test_build_history_starts_over_at_keyframes():
+    changes = [
+        # a broken reverse diff before the keyframe does not reach the versions behind it
+        dict(change(1, 1, T1, 'Addition', None, [{'op': 'replace', 'path': '/title', 'value': 'first'}])),
+        dict(change(2, 1, T2, 'Modification', 1, {'title': 'second'}), content_hash='hash'),
+        dict(change(3, 1, T3, 'Modification', 2, [{'op': 'remove', 'path': '/missing'}])),
+        dict(change(4, 1, datetime(2024, 1, 4), 'Modification', 3, {'title': 'fourth'}), content_hash='newest'),
+    ]
+    history = fapi.build_history(changes)
+    assert [step[0]['content'] for step in history] == [
+        {'title': 'first'}, {'title': 'second'}, None, {'title': 'fourth'}]
+
+
+def test_build_snapshot():
+    # what get_course_snapshot reads for T2: item 1 from its newest version down to T2, item 2 from a keyframe
+    changes = [
+        change(4, 1, T3, 'Modification', 1, {'title': 'new', 'body': 'b'}),
+        change(1, 1, T2, 'Addition', None, [{'op': 'replace', 'path': '/title', 'value': 'old'}]),
+        dict(change(2, 2, T2, 'Modification', None, {'title': 'second'}), content_hash='keyframe'),
+        change(3, 3, T1, 'Deletion', None, {}),
+    ]
+    snapshot = fapi.build_snapshot(changes)
+    assert [(entry['item_id'], entry['timestamp'], entry['content']) for entry in snapshot] == [
+        (1, T2.isoformat(), {'title': 'old', 'body': 'b'}),
+        (2, T2.isoformat(), {'title': 'second'}),
+    ]
+    assert fapi.build_snapshot([]) == []
+
+
+def test_course_id_cache():
+    fapi.course_id_cache.clear()
+    pool = FakePool([])
+
+    assert asyncio.run(fapi.convert_course_id_to_id(pool, '1234')) == 7
+    assert asyncio.run(fapi.convert_course_id_to_id(pool, 1234)) == 7
+    assert sum('FROM courses' in query for query in pool.queries) == 1
+
+    fapi.invalidate_course_id_cache(internal_course_id=7)
+    assert asyncio.run(fapi.convert_course_id_to_id(pool, 1234)) == 7
+    assert sum('FROM courses' in query for query in pool.queries) == 2
+
+
+class CountingPool(FakePool):
+    def __init__(self, changes):
+        super().__init__(changes)
+        self.acquired = 0
+        self.released = 0
+
+    def acquire(self):
+        self.acquired += 1
+        return super().acquire().__aenter__()
+
+    async def release(self, conn):
+        self.released += 1
+
+
+def test_request_connection_is_shared():
+    fapi.history_cache.clear()
+    fapi.course_id_cache.clear()
+    pool = CountingPool([change(1, 1, T1, 'Addition', None, {'title': 'first'})])
+
+    async def request():
+        db = fapi.RequestConnection(pool)
+        try:
+            # looks up the course id and the changes, one connection for both
+            return await fapi.get_history(db, 1234, 'Pages')
+        finally:
+            await db.close()
+
+    assert json.loads(asyncio.run(request()))[0]['content'] == [{'title': 'first'}]
+    assert (pool.acquired, pool.released) == (1, 1)
+
+
+def test_change_feed():
+    fapi.course_id_cache.clear()
+    pool = FakePool([change(3, 1, T3, 'Modification', 1, {'title': 'new'}),
+                     change(2, 2, T2, 'Addition', None, {'title': 'second'})])
+
+    # the fake returns every row, one more than the limit, so there is a next page
+    page = asyncio.run(fapi.get_change_feed(pool, 1234, 1, include_diff=True))
+    assert [(entry['id'], entry['diff']) for entry in page['changes']] == [(3, {'title': 'new'})]
+    assert fapi.decode_feed_cursor(page['next_cursor']) == (T3, 3)
+
+    page = asyncio.run(fapi.get_change_feed(pool, 1234, 5, page['next_cursor'], 'Pages', change_type='Addition'))
+    assert page['next_cursor'] is None
+    query = ' '.join(pool.queries[-1].split())
+    # without the diffs the snapshots are not read
+    assert 'highlights FROM changes WHERE course_id = $1 AND (timestamp, id) < ($2, $3) AND item_type = $4' in query
+    assert 'change_type = $5 ORDER BY timestamp DESC, id DESC LIMIT $6' in query
+
+    with pytest.raises(ValueError):
+        fapi.decode_feed_cursor('not a cursor')
+
+
+def test_format_history():
+    changes = [
+        change(1, 1, T1, 'Addition', None, {'title': 'first'}),
+        change(2, 2, T2, 'Addition', None, {'title': 'second'}),
+    ]
+    steps = fapi.build_history(changes)
+    documents = list(fapi.format_history(steps))
+
+    assert [(document['id'], document['older_diff'], document['content']) for document in documents] == [
+        (0, None, [{'title': 'first'}]),
+        (1, 0, [{'title': 'first'}, {'title': 'second'}]),
+    ]
+    # the steps stay as they are, they can be cached
+    assert steps[1][0]['id'] == 1 and steps[1][0]['content'] == {'title': 'first'}
+
+
+def test_history_chunks_are_cached():
+    fapi.history_cache.clear()
+    fapi.course_id_cache.clear()
+    pool = FakePool([change(1, 1, T1, 'Addition', None, {'title': 'first'})])
+
+    async def read():
+        return [chunk async for chunk in await fapi.get_history_chunks(pool, 1234, 'Pages')]
+
+    first = asyncio.run(read())
+    assert json.loads(b''.join(first)) == json.loads(asyncio.run(fapi.get_history(pool, 1234, 'Pages')))
+    assert sum(query.startswith('SELECT * FROM change_records') for query in pool.queries) == 1
+
+
+class CursorConnection(FakeConnection):
+    def transaction(self):
+        return self
+
+    async def _rows(self):
+        for row in self.changes:
+            yield row
+
+    def cursor(self, query, *args, prefetch=None):
+        self.queries.append(query)
+        return self._rows()
+
+
+class CursorPool(FakePool):
+    def acquire(self):
+        return CursorConnection(self.changes, self.queries)
+
+
+def test_stream_item_histories():
+    fapi.course_id_cache.clear()
+    pool = CursorPool([
+        change(1, 1, T1, 'Addition', None, [{'op': 'replace', 'path': '/title', 'value': 'old'}]),
+        change(3, 1, T3, 'Modification', 1, {'title': 'new'}),
+        change(2, 2, T2, 'Addition', None, {'title': 'second'}),
+    ])
+
+    async def read():
+        return [line async for line in fapi.stream_item_histories(pool, 1234, 'Pages')]
+
+    lines = asyncio.run(read())
+    assert all(line.endswith(b'\n') for line in lines)
+    versions = [json.loads(line) for line in lines]
+    assert [(version['item_id'], version['timestamp'], version['content']) for version in versions] == [
+        (1, T1.isoformat(), {'title': 'old'}),
+        (1, T3.isoformat(), {'title': 'new'}),
+        (2, T2.isoformat(), {'title': 'second'}),
+    ]
+
+
+class HighlightConnection(RecordingConnection):
+    def __init__(self, updated):
+        super().__init__()
+        self.updated = updated
+
+    async def fetchrow(self, query, *args):
+        # canvas course 1234 is course 7
+        return {'id': 7}
+
+    async def execute(self, query, *args):
+        await super().execute(query, *args)
+        return f'UPDATE {self.updated}'
+
+
+def test_put_highlight_drops_cached_histories():
+    fapi.history_cache.clear()
+    fapi.course_id_cache.clear()
+    fapi.history_cache[(7, 'Pages')] = ((1, 1), [b'{}'])
+    fapi.history_cache[(8, 'Pages')] = ((1, 1), [b'{}'])
+    conn = HighlightConnection(1)
+
+    # the highlights are part of every history document, but do not change its version
+    assert asyncio.run(fapi.put_highlight(conn, 1234, 3, SimpleNamespace(highlight='text')))
+    assert conn.statements[0][1] == ('text', 3, 7)
+    assert list(fapi.history_cache) == [(8, 'Pages')]
+
+    # a change of another course is not updated
+    assert not asyncio.run(fapi.put_highlight(HighlightConnection(0), 1234, 4, SimpleNamespace(highlight='text')))
+    assert list(fapi.history_cache) == [(8, 'Pages')]
+
+
+def test_changes_keep_their_api_shape():
+    row = dict(change(1, 1, T1, 'Addition', None, {'title': 'first'}), content_hash='hash', chain_length=0,
+               chain_bytes=0)
+    pool = FakePool([dict(row, diff={'title': 'first'})])
+
+    # JSONB diffs are returned as JSON text, as they were from the TEXT column
+    changes = asyncio.run(fapi.get_changes_by_courseid(pool, 7))
+    assert json.loads(changes[0]['diff']) == {'title': 'first'}
+    assert pool.queries[-1].startswith(f'SELECT {fapi.CHANGE_COLUMNS} FROM change_records')
+    assert fapi.change_response(None) is None
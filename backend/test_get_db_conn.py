@@ -0,0 +1,56 @@
+import asyncio
+from types import SimpleNamespace
+
+from db.get_db_conn import MeteredPool, PoolMetrics
+
+
+class FakePool:
+    def __init__(self):
+        self.free = ['a', 'b']
+        self.released = []
+
+    async def acquire(self, timeout=None):
+        return self.free.pop()
+
+    async def release(self, conn):
+        self.released.append(conn)
+        self.free.append(conn)
+
+    def get_size(self):
+        return 2
+
+    def get_max_size(self):
+        return 4
+
+    def get_idle_size(self):
+        return len(self.free)
+
+
+def test_metered_pool():
+    pool = MeteredPool(FakePool(), PoolMetrics())
+
+    async def use():
+        async with pool.acquire() as first:
+            # awaited like the acquire of asyncpg, released by hand
+            second = await pool.acquire()
+            in_use = pool.get_stats()['in_use']
+            await pool.release(second)
+        return first, second, in_use
+
+    first, second, in_use = asyncio.run(use())
+    assert (first, second, in_use) == ('b', 'a', 2)
+    assert pool.pool.released == ['a', 'b']
+
+    stats = pool.get_stats()
+    assert (stats['acquires'], stats['in_use'], stats['waiting'], stats['max_size']) == (2, 0, 0, 4)
+
+
+def test_query_metrics():
+    metrics = PoolMetrics()
+    metrics.record_query(SimpleNamespace(query='SELECT *\n  FROM changes', elapsed=0.5, exception=None))
+    metrics.record_query(SimpleNamespace(query='SELECT * FROM changes', elapsed=1.5, exception=ValueError()))
+    metrics.record_query(SimpleNamespace(query='SELECT 1', elapsed=0.1, exception=None))
+
+    queries = metrics.get_stats()['queries']
+    assert list(queries) == ['SELECT * FROM changes', 'SELECT 1']
+    assert queries['SELECT * FROM changes'] == {'count': 2, 'errors': 1, 'total': 2.0, 'max': 1.5, 'mean': 1.0}
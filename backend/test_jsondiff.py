@@ -0,0 +1,171 @@
+import asyncio
+import json
+import os
+import random
+import subprocess
+
+import pytest
+
+import jsondiff
+
+
+JSON_BINARY = os.path.join(os.path.dirname(__file__), 'json', 'json')
+
+
+def binary_available():
+    try:
+        subprocess.run([JSON_BINARY], input=b'diff\n{}\n{}\n',
+                       capture_output=True, check=True, timeout=5)
+        return True
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+
+def run_binary(mode, json1, json2):
+    process = subprocess.run(
+        [JSON_BINARY],
+        input=f'{mode}\n{json.dumps(json1)}\n{json.dumps(json2)}\n'.encode(),
+        capture_output=True
+    )
+    output = process.stdout.decode()
+    return json.loads(output.rstrip('\n')) if output else None
+
+
+# (source, target, diff) triples, the diffs were produced by ./json/json
+DIFF_CASES = [
+    ({'name': 'Random Course'}, {'name': 'Random Course'}, []),
+    ({'name': 'Random Course 2'}, {'name': 'Random Course'},
+     [{'op': 'replace', 'path': '/name', 'value': 'Random Course'}]),
+    ({'a': 1}, {'a': 1.0}, []),
+    ({'a': True}, {'a': 1}, [{'op': 'replace', 'path': '/a', 'value': 1}]),
+    ([1, 2], {'0': 1}, [{'op': 'replace', 'path': '', 'value': {'0': 1}}]),
+    (5, 'x', [{'op': 'replace', 'path': '', 'value': 'x'}]),
+    ({'a': {'b': {'c': 1}}}, {'a': {'b': {}}},
+     [{'op': 'remove', 'path': '/a/b/c'}]),
+    ({'a': [1, {'b': None}]}, {'a': [1, {'b': 'x'}, 3, 4]},
+     [{'op': 'replace', 'path': '/a/1/b', 'value': 'x'},
+      {'op': 'add', 'path': '/a/-', 'value': 3},
+      {'op': 'add', 'path': '/a/-', 'value': 4}]),
+    ({'a': 1, 'b': [1, 2, 3], 'c': {'x~/': 1}},
+     {'a': 2, 'b': [5], 'd': True, 'c': {}},
+     [{'op': 'replace', 'path': '/a', 'value': 2},
+      {'op': 'replace', 'path': '/b/0', 'value': 5},
+      {'op': 'remove', 'path': '/b/2'},
+      {'op': 'remove', 'path': '/b/1'},
+      {'op': 'remove', 'path': '/c/x~0~1'},
+      {'op': 'add', 'path': '/d', 'value': True}]),
+]
+
+
+def random_json(rng, depth=3):
+    kind = rng.randrange(8 if depth else 5)
+    if kind == 0:
+        return None
+    if kind == 1:
+        return rng.choice([True, False])
+    if kind == 2:
+        return rng.randrange(-3, 4)
+    if kind == 3:
+        return rng.choice([0.5, 1.0, -2.25])
+    if kind == 4:
+        return rng.choice(['', 'a', 'b/c', '~x', '<p>page</p>'])
+    if kind in (5, 6):
+        keys = rng.sample(['id', 'name', 'a/b', 'm~n', 'body', 'items'], rng.randrange(5))
+        return {key: random_json(rng, depth - 1) for key in keys}
+    return [random_json(rng, depth - 1) for _ in range(rng.randrange(5))]
+
+
+def random_pairs(count):
+    rng = random.Random(6902)
+    return [(random_json(rng), random_json(rng)) for _ in range(count)]
+
+
+@pytest.mark.parametrize('source,target,expected', DIFF_CASES)
+def test_diff_matches_recorded_output(source, target, expected):
+    assert jsondiff.diff(source, target) == expected
+
+
+@pytest.mark.parametrize('source,target,expected', DIFF_CASES)
+def test_patch_reverses_recorded_diff(source, target, expected):
+    assert jsondiff.patch(source, expected) == target
+
+
+def test_patch_operations():
+    document = {'a': [1, 2]}
+    result = jsondiff.patch(document, [
+        {'op': 'add', 'path': '/a/1', 'value': 9},
+        {'op': 'move', 'from': '/a/0', 'path': '/b'},
+        {'op': 'copy', 'from': '/b', 'path': '/c'},
+        {'op': 'test', 'path': '/c', 'value': 1},
+    ])
+    assert result == {'a': [9, 2], 'b': 1, 'c': 1}
+    assert document == {'a': [1, 2]}
+
+
+@pytest.mark.parametrize('operations', [
+    [{'op': 'remove', 'path': '/x'}],
+    [{'op': 'replace', 'path': '/x', 'value': 1}],
+    [{'op': 'add', 'path': '/a/5', 'value': 1}],
+    [{'op': 'add', 'path': '/a/01', 'value': 1}],
+    [{'op': 'test', 'path': '/a/0', 'value': True}],
+    [{'op': 'frobnicate', 'path': ''}],
+    [{'path': '/a'}],
+    {'op': 'remove', 'path': '/a'},
+])
+def test_patch_errors(operations):
+    with pytest.raises(jsondiff.JsonPatchError):
+        jsondiff.patch({'a': [1]}, operations)
+
+
+def test_try_patch():
+    assert jsondiff.try_patch({'a': 1}, [{'op': 'remove', 'path': '/a'}]) == {}
+    assert jsondiff.try_patch({}, [{'op': 'remove', 'path': '/a'}]) is None
+
+
+def test_random_round_trip():
+    for source, target in random_pairs(500):
+        assert jsondiff.patch(source, jsondiff.diff(source, target)) == target
+        assert jsondiff.patch(target, jsondiff.diff(target, source)) == source
+
+
+@pytest.mark.skipif(not binary_available(), reason='./json/json can not run here')
+def test_compatible_with_binary():
+    for source, target in random_pairs(200) + [c[:2] for c in DIFF_CASES]:
+        expected = run_binary('diff', source, target)
+        assert jsondiff.diff(source, target) == expected
+        assert jsondiff.patch(source, expected) == run_binary('patch', source, expected)
+
+
+def test_batches_keep_order():
+    pairs = random_pairs(50)
+    diffs = asyncio.run(jsondiff.diff_many(pairs))
+    assert diffs == [jsondiff.diff(source, target) for source, target in pairs]
+    patched = asyncio.run(jsondiff.patch_many(
+        [(source, d) for (source, _), d in zip(pairs, diffs)] + [({}, [{'op': 'remove', 'path': '/x'}])]))
+    assert patched == [target for _, target in pairs] + [None]
+
+
+@pytest.mark.skipif(not binary_available(), reason='./json/json can not run here')
+def test_worker_pool_matches_in_process():
+    pairs = random_pairs(300)
+
+    async def run():
+        async with jsondiff.JsonWorkerPool(3) as pool:
+            diffs = await pool.run('diff', pairs)
+            patch_pairs = [(source, d) for (source, _), d in zip(pairs, diffs)]
+            patch_pairs.append(({}, [{'op': 'remove', 'path': '/x'}]))
+            patched = await pool.run('patch', patch_pairs)
+            # workers stay alive and keep serving after a failed job
+            again = await pool.run('diff', pairs[:5])
+        return diffs, patched, again
+
+    diffs, patched, again = asyncio.run(run())
+    assert diffs == [jsondiff.diff(source, target) for source, target in pairs]
+    assert patched == [target for _, target in pairs] + [None]
+    assert again == diffs[:5]
+
+
+def test_content_hash_is_canonical():
+    assert jsondiff.content_hash({'a': 1, 'b': [1, 2]}) == jsondiff.content_hash({'b': [1, 2], 'a': 1})
+    assert jsondiff.content_hash({'a': 1}) != jsondiff.content_hash({'a': True})
+    assert len(jsondiff.content_hash(None)) == 32